@@ -0,0 +1,113 @@
+# Project libs
+from configs import config
+import metrics
+
+# Standard libs
+import collections, time
+
+
+# Decisions of Gate.admit
+ADMIT = 'admitted'
+NOTICE = 'notice' # over the limit: the user is told once
+DROP = 'dropped' # over the limit again, or over the global budget: ignored without any reply
+
+
+class Gate():
+    """
+    Admission control of incoming messages, with token buckets: one per user, and a global one.
+    A bucket holds up to burst tokens, refilled at rate tokens per second; each message takes one.
+    Deciding only needs arithmetic, so it is done before any I/O.
+
+    Buckets of users are kept in recently used order: the ones that stayed idle long enough
+    to be full again are evicted (a new bucket is the same), and there are at most maxsize of them.
+    """
+    def __init__(self, rate=0.5, burst=5, global_rate=20, global_burst=40, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.idle = burst / rate # seconds for an empty bucket to be full again
+        self.maxsize = maxsize
+        self.buckets = collections.OrderedDict() # user ID -> [tokens, last update, notified]
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.global_bucket = [global_burst, None] # tokens, last update
+
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+    def admit(self, user_id, now=None):
+        """
+        Decides what to do with a message.
+
+        Args:
+            user_id (int): ID of the author of the message
+            now (float, optional): time.monotonic() of reference. Defaults to current time.
+
+        Returns:
+            str: ADMIT, NOTICE or DROP
+        """
+        if now is None:
+            now = time.monotonic()
+        self.evict(now)
+
+        bucket = self.buckets.pop(user_id, None)
+        if bucket is None:
+            bucket = [self.burst, now, False]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self.buckets[user_id] = bucket # most recently used at the end
+
+        global_bucket = self.global_bucket
+        if global_bucket[1] is not None:
+            global_bucket[0] = min(self.global_burst, global_bucket[0] + (now - global_bucket[1]) * self.global_rate)
+        global_bucket[1] = now
+
+        if bucket[0] < 1:
+            decision = DROP if bucket[2] else NOTICE
+            bucket[2] = True
+        elif global_bucket[0] < 1:
+            decision = DROP
+        else:
+            bucket[0] -= 1
+            bucket[2] = False
+            global_bucket[0] -= 1
+            decision = ADMIT
+
+        metrics.admissions.inc(decision)
+        return decision
+
+
+    def evict(self, now):
+        """
+        Removes the buckets of the users that have been idle long enough, and the least recently used ones over maxsize.
+
+        Args:
+            now (float): time.monotonic() of reference
+        """
+        buckets = self.buckets
+        while buckets:
+            user_id, bucket = next(iter(buckets.items()))
+            if len(buckets) < self.maxsize and now - bucket[1] < self.idle:
+                return
+            del buckets[user_id]
+
+
+def gate():
+    """
+    Creates a gate configured from the "admission" section of the config file.
+
+    Returns:
+        Gate: Gate object, or None if admission control is disabled
+    """
+    settings = config.get('admission') or {}
+    if not settings.get('enabled', True):
+        return None
+    return Gate(
+        rate=settings.get('rate', 0.5),
+        burst=settings.get('burst', 5),
+        global_rate=settings.get('global_rate', 20),
+        global_burst=settings.get('global_burst', 40),
+        maxsize=settings.get('users', 10000)
+    )
@@ -1,5 +1,5 @@
-import logging
-from logging.handlers import RotatingFileHandler
+import atexit, logging, queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 """
 Wrapper for the logging module, which is an hell in terms of design.
@@ -16,6 +16,9 @@ ailolog.add_file(l, 'test.log', minlevel="debug")
 
 l.debug('coucou')
 ```
+
+To keep slow handlers (files...) out of the calling thread, call `add_queue(l)` once all
+the handlers are added: records are then formatted and written by a background thread.
 """
 
 DEFAULT_LINE_FORMAT = '[%(asctime)s][%(name)s][%(levelname)s] %(message)s'
@@ -66,6 +69,82 @@ def add_console(logger, minlevel='trace', line_format=DEFAULT_LINE_FORMAT, time_
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+def add_queue(logger, maxsize=10000, policy='drop'):
+    """
+    Moves the handlers of the logger behind a queue, emptied by a background thread.
+    Logging calls then only put the record in the queue; formatting (including the str()
+    of the objects given as message or args) and writing happen in the background thread.
+    policy tells what to do when the queue is full: 'drop' the record, or 'block' until there is room.
+    Dropped records are counted, and reported by a warning once there is room again (or at exit).
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    records = queue.Queue(maxsize)
+    handler = _BoundedQueueHandler(records, policy, logger.name)
+    handler.setLevel(min((h.level for h in handlers), default=logging.NOTSET))
+    logger.addHandler(handler)
+
+    listener = _Listener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append((listener, handler))
+    return handler
+
+def flush():
+    """
+    Writes all the records still in the queues, and stops the background threads.
+    Called automatically when the program exits.
+    """
+    while _listeners:
+        listener, handler = _listeners.pop()
+        listener.stop()
+        record = handler.report()
+        if record is not None:
+            listener.handle(record)
+
+_listeners = []
+atexit.register(flush)
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full: waiting for room, instead of failing to stop
+        self.queue.put(self._sentinel)
+
+
+class _BoundedQueueHandler(QueueHandler):
+    def __init__(self, records, policy='drop', name=''):
+        super().__init__(records)
+        self.policy = policy
+        self.logger_name = name
+        self.dropped = 0
+        self.reported = 0 # dropped records already reported
+
+    def prepare(self, record):
+        # the record stays in this process, so formatting can be left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            report = self.report()
+            if report is not None:
+                self.queue.put_nowait(report)
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def report(self):
+        # warning record telling how many records were dropped since the last report, None if there are none
+        if self.dropped == self.reported:
+            return None
+        return logging.LogRecord(self.logger_name, logging.WARNING, __file__, 0, '%s log lines dropped: the queue was full', (self.dropped - self.reported,), None)
+
+
 def _string_to_levelname(string):
     if string in ('critical', 'CRITICAL', 'crit', 'CRIT'):
         return logging.CRITICAL
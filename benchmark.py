@@ -0,0 +1,424 @@
+"""
+Offline benchmarks of boomerang hot paths. Nothing is sent to Discord: a stand-in
+client records the messages instead, optionally after some artificial latency.
+Databases are created in a temporary directory.
+
+Usage:
+```
+python3 benchmark.py parser [--iterations 100000]
+python3 benchmark.py fire [--reminders 10000] [--authors 1000] [--window 10] [--distribution uniform|peak] [--latency 0.05] [--workers 8] [--no-coalesce] [--tolerance 0]
+python3 benchmark.py fate [--reminders 100000]
+python3 benchmark.py commands [--messages 5000]
+python3 benchmark.py messages [--messages 5000]
+```
+"""
+
+# Project libs
+import commands, delivery, grammar, main, models, utils
+from grammar import Spec
+
+# Standard libs
+import argparse, asyncio, collections, os, random, sys, tempfile, time
+
+
+# ------------------------------------- #
+# Discord stand-in                      #
+# ------------------------------------- #
+
+class FakeUser():
+    """
+    Stand-in for discord.User, recording what is sent to it.
+    """
+    def __init__(self, id, client):
+        self.id = id
+        self.name = f'user{id}'
+        self.discriminator = '0'
+        self.bot = False
+        self.client = client
+
+
+    async def send(self, content=None, embed=None, embeds=None):
+        await self.client.request()
+        for item in embeds or [content if embed is None else embed]:
+            self.client.sent.append((time.time(), self.id, item))
+
+
+    async def typing(self):
+        await self.client.request()
+
+
+class FakeClient():
+    """
+    Stand-in for discord.Client. Every REST call waits for latency seconds, and is counted.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.sent = []
+        self.loop = asyncio.get_running_loop()
+        self.settling = set()
+
+
+    async def request(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+    async def wait_until_ready(self):
+        pass
+
+
+    async def change_presence(self, **kwargs):
+        await self.request()
+
+
+    async def fetch_user(self, id):
+        await self.request()
+        return FakeUser(id, self)
+
+
+class FakeMessage():
+    """
+    Stand-in for discord.Message received in DMs.
+    """
+    def __init__(self, content, author):
+        self.content = content
+        self.author = author
+        self.channel = author # the DM channel, only used for typing
+        self.guild = None
+
+
+class RecordingDispatcher(delivery.Dispatcher):
+    """
+    Dispatcher remembering when each reminder was delivered.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delivered = {} # reminder ID -> timestamp
+
+
+    def record(self, reminder_id, outcome, author=None, due=None):
+        super().record(reminder_id, outcome, author, due)
+        if outcome == 'delivered':
+            self.delivered[reminder_id] = time.time()
+
+
+# ------------------------------------- #
+# Helpers                               #
+# ------------------------------------- #
+
+def use_temporary_database():
+    """
+    Points models.Database to a new database in a temporary directory.
+    """
+    models.Database.close()
+    models.Database.path = os.path.join(tempfile.mkdtemp(prefix='boomerang-bench-'), 'boomerang.sqlite3')
+    return models.Database()
+
+
+def seed(db, count, authors, start, window, distribution='uniform', recurring=0.2):
+    """
+    Fills the database with reminders.
+
+    Args:
+        db (models.Database): Database instance
+        count (int): How many reminders
+        authors (int): Among how many users they are spread
+        start (int): Timestamp of the first reminder
+        window (int): Reminders fall between start and start+window seconds
+        distribution (str, optional): "uniform" (spread over the window) or "peak" (all at start+window)
+        recurring (float, optional): Share of recurring reminders. Defaults to 0.2.
+
+    Returns:
+        dict: Reminder ID -> date_next
+    """
+    rows = []
+    for _ in range(count):
+        if distribution == 'peak':
+            date_next = start + window
+        else:
+            date_next = start + random.randint(0, window)
+        recurrence = '1d' if random.random() < recurring else None
+        rows.append((random.randint(1, authors), start, date_next, recurrence, None, 'Benchmark reminder', 0x3498db))
+
+    with db.base:
+        db.cursor.executemany("INSERT INTO reminders (author, date_creation, date_next, recurrence, recurrence_limit, text, color) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    db.cursor.execute("SELECT id, date_next FROM reminders")
+    return {row["id"]: row["date_next"] for row in db.cursor.fetchall()}
+
+
+class StatementCounter():
+    """
+    Counts the SQL statements run on the shared connection.
+    """
+    def __init__(self, db):
+        self.count = 0
+        db.base.set_trace_callback(self.trace)
+
+
+    def trace(self, statement):
+        self.count += 1
+
+
+def percentiles(values):
+    """
+    Returns a summary of a list of durations, in milliseconds.
+    """
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda p: values[min(len(values)-1, int(p*len(values)))] * 1000
+    return f"p50 {pick(0.5):.1f} ms, p95 {pick(0.95):.1f} ms, p99 {pick(0.99):.1f} ms, max {values[-1]*1000:.1f} ms"
+
+
+# ------------------------------------- #
+# Parser                                #
+# ------------------------------------- #
+
+# Messages and what the parser is expected to return for them.
+# Checked before benchmarking, so that a faster parser is not a wrong one.
+PARSER_CORPUS = (
+    ("in 8h, wake up", Spec('in', '8h', None, None, None, None, 'wake up')),
+    ("in 2d 3h 5m, look out", Spec('in', '2d 3h 5m', None, None, None, None, 'look out')),
+    ("in 1n 2w 3d 4h 5m, everything", Spec('in', '1n 2w 3d 4h 5m', None, None, None, None, 'everything')),
+    ("in 1M, month", Spec('in', '1M', None, None, None, None, 'month')),
+    ("in 8h every 1d, wake up", Spec('in', '8h', None, None, None, '1d', 'wake up')),
+    ("in 8h every 1w 2d, x", Spec('in', '8h', None, None, None, '1w 2d', 'x')),
+    ("at 8, wake up", Spec('at', None, None, 8, None, None, 'wake up')),
+    ("at 8h, wake up", Spec('at', None, None, 8, None, None, 'wake up')),
+    ("at 19:00, water flowers", Spec('at', None, None, 19, 0, None, 'water flowers')),
+    ("at 19h30, dinner", Spec('at', None, None, 19, 30, None, 'dinner')),
+    ("at 1930, dinner", Spec('at', None, None, 19, 30, None, 'dinner')),
+    ("at 8 every 1d, wake up", Spec('at', None, None, 8, None, '1d', 'wake up')),
+    ("at 7:45 every 1d, bus", Spec('at', None, None, 7, 45, '1d', 'bus')),
+    ("on 6, make backups", Spec('on', None, 6, None, None, None, 'make backups')),
+    ("on 15 at 12h, lunch outside", Spec('on', None, 15, 12, None, None, 'lunch outside')),
+    ("on 15 at 12, lunch outside", Spec('on', None, 15, 12, None, None, 'lunch outside')),
+    ("on 1 at 9:30, rent", Spec('on', None, 1, 9, 30, None, 'rent')),
+    ("on 1 at 9:30 every 1M, rent", Spec('on', None, 1, 9, 30, '1M', 'rent')),
+    ("on 28 every 1n, pay", Spec('on', None, 28, None, None, '1n', 'pay')),
+    ("in 8h,no space", Spec('in', '8h', None, None, None, None, 'no space')),
+    ("in, nothing", None),
+    ("in 8h every, nothing", None),
+    ("in 8h wake up", None),
+    ("in 3d 2h, wrong order", Spec('in', '3d 2h', None, None, None, None, 'wrong order')),
+    ("in 2h 3d, wrong order", None),
+    ("at, nothing", None),
+    ("at 123 every 1d, odd", Spec('at', None, None, 12, 3, '1d', 'odd')),
+    ("at 9 ~5m, standup", Spec('at', None, None, 9, None, None, 'standup', 300)),
+    ("in 8h every 1d ~1h, stretch", Spec('in', '8h', None, None, None, '1d', 'stretch', 3600)),
+    ("at 9 ~, standup", None),
+    ("at eight, wake up", None),
+    ("on 6 at, nothing", None),
+    ("At 8, capitalized", None),
+    ("remind me in 8h, nope", None),
+)
+
+
+def bench_parser(iterations):
+    failures = 0
+    for message, expected in PARSER_CORPUS:
+        result = grammar.parse_reminder(message)
+        if result != expected:
+            failures += 1
+            print(f"FAIL {message!r}: expected {expected}, got {result}")
+    if failures:
+        print(f"{failures} parser cases failed")
+        return 1
+    print(f"{len(PARSER_CORPUS)} parser cases passed")
+
+    for message, _ in PARSER_CORPUS:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            grammar.parse_reminder(message)
+        duration = (time.perf_counter() - start) / iterations
+        print(f"{duration*1e6:8.2f} µs  {message}")
+    return 0
+
+
+# ------------------------------------- #
+# Fire loop                             #
+# ------------------------------------- #
+
+async def bench_fire(args):
+    db = use_temporary_database()
+    start = int(time.time()) + 2
+    dates = seed(db, args.reminders, args.authors, start, args.window, args.distribution)
+    counter = StatementCounter(db)
+    print(f"Seeded {args.reminders} reminders ({args.distribution}) over {args.window}s")
+
+    client = FakeClient(args.latency)
+    client.dispatcher = RecordingDispatcher(client, workers=args.workers, backoff=0.1, coalesce=args.coalesce)
+    delivery.users.clear()
+    main.timeline.tolerance = args.tolerance
+
+    # timing each tick of the fire loop
+    ticks = []
+    original_tick = main.tick
+    async def timed_tick(client, db):
+        tick_start = time.perf_counter()
+        await original_tick(client, db)
+        ticks.append(time.perf_counter() - tick_start)
+    main.tick = timed_tick
+
+    task = asyncio.create_task(main.loop(client))
+    deadline = start + args.window + args.tolerance + 60
+    while len(client.dispatcher.delivered) < len(dates) and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    task.cancel()
+    main.tick = original_tick
+    main.timeline.tolerance = 0
+
+    lateness = [client.dispatcher.delivered[id] - dates[id] for id in client.dispatcher.delivered]
+    delivered = len(client.dispatcher.delivered)
+    print(f"Delivered: {delivered}/{len(dates)}")
+    print(f"Ticks: {len(ticks)}, duration {percentiles(ticks)}")
+    print(f"Firing lateness: {percentiles(lateness)}")
+    print(f"Peak deliveries per second: {max(collections.Counter(int(date) for date in client.dispatcher.delivered.values()).values(), default=0)}")
+    print(f"REST calls per reminder: {client.requests / max(delivered, 1):.2f}")
+    print(f"SQL statements per reminder: {counter.count / max(delivered, 1):.2f}")
+    return 0 if delivered == len(dates) else 1
+
+
+async def bench_fate(args):
+    db = use_temporary_database()
+    now = int(time.time())
+    seed(db, args.reminders, args.authors, now - 60, 59)
+    counter = StatementCounter(db)
+    adb = models.AsyncDatabase()
+
+    select_start = time.perf_counter()
+    reminders = await adb.select_reminders_now()
+    fate_start = time.perf_counter()
+    await utils.reminders_fate(adb, reminders)
+    end = time.perf_counter()
+
+    print(f"{len(reminders)} due reminders")
+    print(f"select_reminders_now: {(fate_start-select_start)*1000:.1f} ms")
+    print(f"reminders_fate: {(end-fate_start)*1000:.1f} ms ({(end-fate_start)/max(len(reminders), 1)*1e6:.1f} µs per reminder)")
+    print(f"SQL statements per reminder: {counter.count / max(len(reminders), 1):.2f}")
+    return 0
+
+
+COMMANDS_MIX = (
+    "in 8h, wake up",
+    "in 2d 3h 5m every 1w, look out",
+    "at 19:00, water flowers",
+    "on 15 at 12h every 1M, lunch outside",
+    "cron 0 8 * * 1, weekly",
+    "list",
+    "help",
+    "something unrecognized",
+)
+
+
+async def bench_commands(args):
+    db = use_temporary_database()
+    seed(db, args.reminders, args.authors, int(time.time()) + 86400, 86400)
+    counter = StatementCounter(db)
+    utils.load_templates()
+    client = FakeClient(args.latency)
+
+    users = [FakeUser(id, client) for id in range(1, args.authors+1)]
+    for user in users:
+        await commands.handler(client, FakeMessage('tz Europe/Paris', user))
+    client.requests = 0
+    counter.count = 0
+
+    durations = []
+    begin = time.perf_counter()
+    for i in range(args.messages):
+        message = FakeMessage(COMMANDS_MIX[i % len(COMMANDS_MIX)], users[i % len(users)])
+        start = time.perf_counter()
+        await commands.handler(client, message)
+        durations.append(time.perf_counter() - start)
+    total = time.perf_counter() - begin
+
+    print(f"{args.messages} commands in {total:.2f}s ({args.messages/total:.0f} commands/s)")
+    print(f"Handler latency: {percentiles(durations)}")
+    print(f"REST calls per command: {client.requests / args.messages:.2f}")
+    print(f"SQL statements per command: {counter.count / args.messages:.2f}")
+    return 0
+
+
+async def bench_messages(args):
+    db = use_temporary_database()
+    seed(db, args.reminders, args.authors, int(time.time()) + 86400, 86400)
+    utils.load_templates()
+    client = FakeClient(args.latency)
+    client.user = FakeUser(0, client)
+    client.gate = None # measuring the handling of messages, not the limits
+
+    users = [FakeUser(id, client) for id in range(1, args.authors+1)]
+    for user in users:
+        await commands.handler(client, FakeMessage('tz Europe/Paris', user))
+    client.requests = 0
+
+    durations = []
+    begin = time.perf_counter()
+    for i in range(args.messages):
+        message = FakeMessage(COMMANDS_MIX[i % len(COMMANDS_MIX)], users[i % len(users)])
+        start = time.perf_counter()
+        await main.Client.on_message(client, message)
+        durations.append(time.perf_counter() - start)
+    total = time.perf_counter() - begin
+
+    print(f"{args.messages} messages in {total:.2f}s ({args.messages/total:.0f} messages/s)")
+    print(f"on_message latency: {percentiles(durations)}")
+    print(f"REST calls per message: {client.requests / args.messages:.2f}")
+    return 0
+
+
+# ------------------------------------- #
+# Command line                          #
+# ------------------------------------- #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks of boomerang")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('parser', help="parsing of reminder commands")
+    p.add_argument('--iterations', type=int, default=100000)
+
+    p = subparsers.add_parser('fire', help="fire loop and delivery, with reminders due in the next seconds")
+    p.add_argument('--reminders', type=int, default=10000)
+    p.add_argument('--authors', type=int, default=1000)
+    p.add_argument('--window', type=int, default=10, help="seconds over which the reminders are due")
+    p.add_argument('--distribution', choices=('uniform', 'peak'), default='uniform')
+    p.add_argument('--latency', type=float, default=0.05, help="seconds taken by each Discord REST call")
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--coalesce', action=argparse.BooleanOptionalAction, default=True, help="send the reminders of a same user together")
+    p.add_argument('--tolerance', type=int, default=0, help="tolerance window of the reminders, in seconds")
+
+    p = subparsers.add_parser('fate', help="rescheduling of a batch of due reminders")
+    p.add_argument('--reminders', type=int, default=100000)
+    p.add_argument('--authors', type=int, default=1000)
+
+    p = subparsers.add_parser('commands', help="command handler throughput")
+    p.add_argument('--messages', type=int, default=5000)
+    p.add_argument('--reminders', type=int, default=100000, help="reminders already in database")
+    p.add_argument('--authors', type=int, default=100)
+    p.add_argument('--latency', type=float, default=0)
+
+    p = subparsers.add_parser('messages', help="incoming messages, from on_message (filters, typing indicator and commands)")
+    p.add_argument('--messages', type=int, default=5000)
+    p.add_argument('--reminders', type=int, default=100000, help="reminders already in database")
+    p.add_argument('--authors', type=int, default=100)
+    p.add_argument('--latency', type=float, default=0)
+
+    args = parser.parse_args()
+    if args.benchmark == 'parser':
+        status = bench_parser(args.iterations)
+    elif args.benchmark == 'fire':
+        status = asyncio.run(bench_fire(args))
+    elif args.benchmark == 'fate':
+        status = asyncio.run(bench_fate(args))
+    elif args.benchmark == 'commands':
+        status = asyncio.run(bench_commands(args))
+    elif args.benchmark == 'messages':
+        status = asyncio.run(bench_messages(args))
+
+    models.AsyncDatabase.shutdown()
+    models.Database.close()
+    sys.exit(status)
@@ -0,0 +1,75 @@
+# Standard libs
+import collections, time
+
+
+class LRUCache():
+    """
+    Mapping with a maximum size and an optional time to live.
+    When full, the least recently used entry is evicted; expired entries are
+    evicted when they are accessed.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict() # key -> (expiration, value)
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for a key, and marks it as recently used.
+
+        Args:
+            key: Key to look for
+            default (optional): Value returned if the key is missing or expired. Defaults to None.
+
+        Returns:
+            Value stored for the key, or default
+        """
+        try:
+            expiration, value = self.data[key]
+        except KeyError:
+            return default
+
+        if expiration is not None and expiration < time.monotonic():
+            del self.data[key]
+            return default
+
+        self.data.move_to_end(key)
+        return value
+
+
+    def put(self, key, value):
+        """
+        Stores a value for a key, evicting the least recently used entry if the cache is full.
+
+        Args:
+            key: Key
+            value: Value to store
+        """
+        expiration = None if self.ttl is None else time.monotonic() + self.ttl
+        self.data[key] = (expiration, value)
+        self.data.move_to_end(key)
+
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+    def pop(self, key):
+        """
+        Removes a key from the cache. Does nothing if it is not there.
+
+        Args:
+            key: Key to remove
+        """
+        self.data.pop(key, None)
+
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        self.data.clear()
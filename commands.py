@@ -1,13 +1,49 @@
 # Project libs
-import models, utils
+from cache import LRUCache
+import cron, grammar, metrics, models, occurrences, utils
 from configs import log
+from scheduler import MAX_TOLERANCE, timeline
 
 # 3rd-party libs
 import discord, pytz
 from dateutil.relativedelta import relativedelta
 
 # Standard libs
-import datetime, random, re
+import datetime, random, time
+
+
+# First word of the message -> command
+COMMANDS = {
+    'timezone': 'tz', 'tz': 'tz',
+    'in': 'in',
+    'at': 'at', 'on': 'at',
+    'cron': 'cron',
+    'list': 'list', 'ls': 'list',
+    'remove': 'remove', 'rm': 'remove', 'delete': 'remove', 'del': 'remove',
+    'help': 'help', '?': 'help',
+}
+
+# Reminders shown per page by the "list" command, short enough to stay under the 2000 characters of a message
+LIST_PAGE_SIZE = 8
+
+# User ID -> timezone (tzinfo) of the user, to avoid reading it from the DB for each command
+timezones = LRUCache(maxsize=10000)
+
+# User ID -> keys (date_next, id) of the first and last reminders of the page of "list" last shown to them
+list_pages = LRUCache(maxsize=10000, ttl=3600)
+
+
+def command_name(content):
+    """
+    Returns the command of a message.
+
+    Args:
+        content (str): Message content
+
+    Returns:
+        str: Canonical name of the command (see COMMANDS), or None if the message is not a command
+    """
+    return COMMANDS.get(content.split(' ', 1)[0].lower())
 
 
 async def handler(client, payload):
@@ -18,35 +54,43 @@ async def handler(client, payload):
         client (discord.Client): Discord client object
         payload (discord.Message): Discord message object
     """
-    command = payload.content.split(' ')[0].lower()
+    command = command_name(payload.content) or 'unrecognized'
+    start = time.perf_counter()
 
-    # Command "timezone" or "tz"
-    if command in ('timezone', 'tz'):
-        await cmd_tz(client, payload)
+    try:
+        # Command "timezone" or "tz"
+        if command == 'tz':
+            await cmd_tz(client, payload)
 
-    # Command "in" (relative reminder)
-    elif command == 'in':
-        await cmd_in(client, payload)
+        # Command "in" (relative reminder)
+        elif command == 'in':
+            await cmd_in(client, payload)
 
-    # Command "at" or "on" (absolute reminder)
-    elif command in ('at', 'on'):
-        await cmd_at(client, payload)
+        # Command "at" or "on" (absolute reminder)
+        elif command == 'at':
+            await cmd_at(client, payload)
 
-    # Command "list"
-    elif command in ('list', 'ls'):
-        await cmd_list(client, payload)
+        # Command "cron" (recurring reminder following a cron expression)
+        elif command == 'cron':
+            await cmd_cron(client, payload)
 
-    # Command "remove"
-    elif command in ('remove', 'rm', "delete", "del"):
-        await cmd_remove(client, payload)
+        # Command "list"
+        elif command == 'list':
+            await cmd_list(client, payload)
 
-    # Command "help"
-    elif command in ('help', '?'):
-        await cmd_help(client, payload)
+        # Command "remove"
+        elif command == 'remove':
+            await cmd_remove(client, payload)
 
-    # Unrecognized command
-    else:
-        await utils.notify('error_unrecognizedCommand', payload.author)
+        # Command "help"
+        elif command == 'help':
+            await cmd_help(client, payload)
+
+        # Unrecognized command
+        else:
+            await utils.notify('error_unrecognizedCommand', payload.author)
+    finally:
+        metrics.command_seconds.observe(time.perf_counter() - start, command)
 
 
 async def cmd_tz(client, payload):
@@ -67,8 +111,9 @@ async def cmd_tz(client, payload):
     if timezone in pytz.all_timezones_set:
         tz = pytz.timezone(timezone)
         
-        db = models.Database()
-        db.update_user_timezone(payload.author, tz)
+        db = models.AsyncDatabase()
+        await db.update_user_timezone(payload.author, tz, occurrences.enabled())
+        timezones.put(payload.author.id, tz)
 
         await utils.notify('success_timezoneChanged', payload.author, {'timezone': str(tz)})
     else:
@@ -84,18 +129,15 @@ async def cmd_in(client, payload):
         client (discord.Client): Discord client object
         payload (discord.Message): Discord message object
     """
-    message = payload.content
-
     # parsing the reminder
-    units = re.search(r'^in((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?)(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', message)
-    if units is None: # If parsing fails
+    spec = grammar.parse_reminder(payload.content)
+    if spec is None or spec.kind != 'in' or (spec.tolerance or 0) > MAX_TOLERANCE: # If parsing fails
         await utils.notify('error_badSyntax', payload.author)
         return
 
-    g = units.groups()
-    timepoint = g[0].strip() # "7h 3m" for example
-    reminder_recurrence = g[1].strip() if g[1] is not None else None # same format as timepoint
-    reminder_text = g[2].strip() # what is after the comma
+    timepoint = spec.timepoint # "7h 3m" for example
+    reminder_recurrence = spec.recurrence # same format as timepoint
+    reminder_text = spec.text # what is after the comma
 
     # Calculating now + specification
     now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
@@ -108,8 +150,9 @@ async def cmd_in(client, payload):
     color = discord.Colour.from_hsv(random.uniform(0, 1), 0.85, 0.88).value
 
     # reminder was parsed, now putting it into db
-    db = models.Database()
-    db.insert_reminder(payload.author, now, reminder_time, reminder_text, color, reminder_recurrence)
+    db = models.AsyncDatabase()
+    reminder_id = await db.insert_reminder(payload.author, now, reminder_time, reminder_text, color, reminder_recurrence, tolerance=spec.tolerance)
+    timeline.push(reminder_id, reminder_time, spec.tolerance)
     
     await utils.notify('success_reminderRegistered', payload.author, {'reminder_time': int(datetime.datetime.timestamp(reminder_time)), 'reminder_text': reminder_text})
 
@@ -118,112 +161,157 @@ async def cmd_at(client, payload):
     """
     at command
     Syntax: at 19, send me this very text
-    (there are several variants, see the regexes)
+    (there are several variants, see grammar.REMINDER)
 
     Args:
         client (discord.Client): Discord client object
         payload (discord.Message): Discord message object
     """
-    regexes = (
-        {'expression': r'^at ([0-9]{1,2})h?(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', 'scope': 'day'},
-        {'expression': r'^at ([0-9]{1,2})(?:h|:)?([0-9]{1,2})(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', 'scope': 'day'},
-        {'expression': r'^on ([0-9]{1,2})(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', 'scope': 'month'},
-        {'expression': r'^on ([0-9]{1,2}) at ([0-9]{1,2})h?(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', 'scope': 'month'},
-        {'expression': r'^on ([0-9]{1,2}) at ([0-9]{1,2})(?:h|:)?([0-9]{1,2})(?:\severy((?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?))?,(.*)$', 'scope': 'month'}
-    )
+    spec = grammar.parse_reminder(payload.content)
+    if spec is None or spec.kind == 'in' or (spec.tolerance or 0) > MAX_TOLERANCE:
+        await utils.notify('error_badSyntax', payload.author)
+        return
 
-    message = payload.content
+    now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
 
-    for i, regex in enumerate(regexes):
-        units = re.search(regex['expression'], message)
-        if units is not None:
-            regex_id = i
-            break
-    else:
-        await utils.notify('error_badSyntax', payload.author)
+    # fetching user timezone
+    db = models.AsyncDatabase()
+    try:
+        tzinfo = await user_timezone(db, payload.author)
+    except IndexError:
+        await utils.notify('error_noTimezoneDefined', payload.author)
         return
-    
-    g = units.groups()
 
-    # Parsing the command depending of the matched regex
-    default = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    # Filling the components that were not given (today, for the user)
+    default = now.astimezone(tzinfo).replace(hour=0, minute=0)
     reminder_time_components = {
         "year": default.year,
         "month": default.month,
-        "day": default.day,
-        "hour": default.hour,
-        "minute": default.minute
+        "day": spec.day if spec.day is not None else default.day,
+        "hour": spec.hour if spec.hour is not None else default.hour,
+        "minute": spec.minute if spec.minute is not None else default.minute
     }
+    reminder_recurrence = spec.recurrence
+    reminder_text = spec.text
 
-    if regex_id == 0:
-        reminder_time_components["hour"] = int(g[0])
-        reminder_recurrence = g[1]
-        reminder_text = g[2]
-    elif regex_id == 1:
-        reminder_time_components["hour"] = int(g[0])
-        reminder_time_components["minute"] = int(g[1])
-        reminder_recurrence = g[2]
-        reminder_text = g[3]
-    elif regex_id == 2:
-        reminder_time_components["day"] = int(g[0])
-        reminder_recurrence = g[1]
-        reminder_text = g[2]
-    elif regex_id == 3:
-        reminder_time_components["day"] = int(g[0])
-        reminder_time_components["hour"] = int(g[1])
-        reminder_recurrence = g[2]
-        reminder_text = g[3]
-    elif regex_id == 4:
-        reminder_time_components["day"] = int(g[0])
-        reminder_time_components["hour"] = int(g[1])
-        reminder_time_components["minute"] = int(g[2])
-        reminder_recurrence = g[3]
-        reminder_text = g[4]
-
-    now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
-
-    # fetching user timezone
-    db = models.Database()
     try:
-        timezone = db.select_user_timezone(payload.author)
-    except IndexError:
-        await utils.notify('error_noTimezoneDefined', payload.author)
+        reminder_time = datetime.datetime(reminder_time_components['year'], reminder_time_components['month'], reminder_time_components['day'], reminder_time_components['hour'], reminder_time_components['minute'], 0)
+    except ValueError: # 25h, 32nd of the month...
+        await utils.notify('error_badSyntax', payload.author)
         return
-        
-    reminder_time = datetime.datetime(reminder_time_components['year'], reminder_time_components['month'], reminder_time_components['day'], reminder_time_components['hour'], reminder_time_components['minute'], 0)
-    tzinfo = pytz.timezone(timezone)
-    reminder_time = tzinfo.localize(reminder_time)
-    log.debug(reminder_time)
 
     # checking if the event has not already passed
     # if not, we have to increment for 1 day/week/month...
-    if now > reminder_time:
-        increase_by = regexes[regex_id]['scope']
-        if increase_by == 'day':
+    # (on the wall clock of the user, before localizing, for DST changes)
+    if now > tzinfo.localize(reminder_time):
+        if spec.kind == 'at':
             reminder_time += relativedelta(days=1)
-        elif increase_by == 'month':
+        elif spec.kind == 'on':
             reminder_time += relativedelta(months=1)
+    reminder_time = tzinfo.localize(reminder_time)
+    log.debug(reminder_time)
 
     color = discord.Colour.from_hsv(random.uniform(0, 1), 0.85, 0.88).value
 
     # reminder was parsed, now putting it into db
-    db = models.Database()
-    db.insert_reminder(payload.author, now, reminder_time, reminder_text, color, reminder_recurrence)
+    reminder_id = await db.insert_reminder(payload.author, now, reminder_time, reminder_text, color, reminder_recurrence, tolerance=spec.tolerance)
+    timeline.push(reminder_id, reminder_time, spec.tolerance)
 
     await utils.notify('success_reminderRegistered', payload.author, {'reminder_time': int(datetime.datetime.timestamp(reminder_time)), 'reminder_text': reminder_text})
 
 
+async def cmd_cron(client, payload):
+    """
+    cron command
+    Syntax: cron 0 8 * * 1, send me this very text
+
+    Args:
+        client (discord.Client): Discord client object
+        payload (discord.Message): Discord message object
+    """
+    # parsing the reminder
+    parsed = grammar.parse_cron(payload.content)
+    if parsed is None or (parsed[2] or 0) > MAX_TOLERANCE: # If parsing fails
+        await utils.notify('error_badSyntax', payload.author)
+        return
+
+    expression, reminder_text, tolerance = parsed # "0 8 * * 1" for example, what is after the comma, and the "~" clause
+
+    # cron expressions follow the wall clock of the user
+    db = models.AsyncDatabase()
+    try:
+        tzinfo = await user_timezone(db, payload.author)
+    except IndexError:
+        await utils.notify('error_noTimezoneDefined', payload.author)
+        return
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    try:
+        reminder_time = cron.next_fire(expression, now, tzinfo)
+    except ValueError:
+        await utils.notify('error_badSyntax', payload.author)
+        return
+
+    color = discord.Colour.from_hsv(random.uniform(0, 1), 0.85, 0.88).value
+
+    # reminder was parsed, now putting it into db
+    reminder_id = await db.insert_reminder(payload.author, now, reminder_time, reminder_text, color, f'cron {expression}', tolerance=tolerance)
+    timeline.push(reminder_id, reminder_time, tolerance)
+
+    await utils.notify('success_reminderRegistered', payload.author, {'reminder_time': int(datetime.datetime.timestamp(reminder_time)), 'reminder_text': reminder_text})
+
+
+async def user_timezone(db, author):
+    """
+    Returns the timezone of someone, from the cache or from the DB.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        author (discord.User): User
+
+    Returns:
+        pytz.tzinfo: Timezone of the user
+
+    Raises:
+        IndexError: If the user did not define their timezone
+    """
+    tzinfo = timezones.get(author.id)
+    if tzinfo is None:
+        tzinfo = pytz.timezone(await db.select_user_timezone(author))
+        timezones.put(author.id, tzinfo)
+    return tzinfo
+
+
 async def cmd_list(client, payload):
     """
     list command
+    Syntax: list, list next, list prev
 
     Args:
         client (discord.Client): Discord client object
         payload (discord.Message): Discord message object
     """
-    db = models.Database()
-    reminders = db.select_reminders_user(payload.author)
-    await utils.notify('info_list', payload.author, vars={"reminders": reminders})
+    db = models.AsyncDatabase()
+    words = payload.content.lower().split()
+    navigation = words[1] if len(words) > 1 else None
+    page = list_pages.get(payload.author.id)
+
+    reminders = []
+    if page is not None and navigation in ('next', 'n'):
+        reminders, more = await db.select_reminders_user(payload.author, after=page[1], limit=LIST_PAGE_SIZE)
+        has_previous, has_next = True, more
+    elif page is not None and navigation in ('prev', 'previous', 'p'):
+        reminders, more = await db.select_reminders_user(payload.author, before=page[0], limit=LIST_PAGE_SIZE)
+        has_previous, has_next = more, True
+
+    # first page (also when going past the end, or when the reminders of the page were removed)
+    if not reminders:
+        reminders, more = await db.select_reminders_user(payload.author, limit=LIST_PAGE_SIZE)
+        has_previous, has_next = False, more
+
+    if reminders:
+        list_pages.put(payload.author.id, ((reminders[0].date_next, reminders[0].id), (reminders[-1].date_next, reminders[-1].id)))
+    await utils.notify('info_list', payload.author, vars={"reminders": reminders, "has_previous": has_previous, "has_next": has_next})
 
 
 async def cmd_remove(client, payload):
@@ -235,27 +323,24 @@ async def cmd_remove(client, payload):
         client (discord.Client): Discord client object
         payload (discord.Message): Discord message object
     """
-    message = payload.content
-
-    regex = re.search(r'^(?:remove|rm|delete|del) ([0-9]+)$', message)
-    try:
-        reminder_to_delete = regex.group(1)
-    except:
+    reminder_to_delete = grammar.parse_remove(payload.content)
+    if reminder_to_delete is None:
         await utils.notify('error_badSyntax', payload.author)
         return
 
     # Checking if the user is the author of the reminder
-    db = models.Database()
+    db = models.AsyncDatabase()
     try:
-        reminder = db.select_reminder(reminder_to_delete)
-        if reminder["author"] != payload.author.id:
+        reminder = await db.select_reminder(reminder_to_delete)
+        if reminder.author != payload.author.id:
             raise ValueError
     except (IndexError, ValueError):
         await utils.notify('error_reminderNotExist', payload.author)
         return
 
     # Deleting
-    db.delete_reminder(reminder_to_delete)
+    await db.delete_reminder(reminder_to_delete, occurrences.enabled())
+    timeline.discard(reminder.id)
     await utils.notify('success_reminderRemoved', payload.author)
         
 
@@ -279,5 +364,7 @@ async def cmd_help(client, payload):
         await utils.notify('help_at', payload.author)
     elif command == 'in':
         await utils.notify('help_in', payload.author)
+    elif command == 'cron':
+        await utils.notify('help_cron', payload.author)
     else:
         await utils.notify('help_general', payload.author)
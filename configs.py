@@ -4,14 +4,26 @@ import ailolog
 # 3rd-party libs
 import yaml
 
+# Standard libs
+import multiprocessing
+
 
 # Loading config
 with open('config.yml', 'r', encoding="utf-8") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 # Setting up logs
+# worker processes (see worker.py) have their own file: processes rotating the same file would lose lines
+process = multiprocessing.current_process().name
+log_path = "logs/boomerang.log" if process == 'MainProcess' else f"logs/{process}.log"
 log = ailolog.logger("boomerang")
 log_discord = ailolog.logger("discord")
-ailolog.add_rotatingfile(log, "logs/boomerang.log", size=100000, rotate=5, minlevel='debug')
-ailolog.add_rotatingfile(log_discord, "logs/boomerang.log", size=100000, rotate=5, minlevel='warning')
+ailolog.add_rotatingfile(log, log_path, size=100000, rotate=5, minlevel='debug')
+ailolog.add_rotatingfile(log_discord, log_path, size=100000, rotate=5, minlevel='warning')
+
+# Writing logs from a background thread, not from the event loop
+logging_settings = config.get('logging') or {}
+if logging_settings.get('queue', True):
+    for logger in (log, log_discord):
+        ailolog.add_queue(logger, maxsize=logging_settings.get('queue_size', 10000), policy=logging_settings.get('when_full', 'drop'))
 log.info("Start of process")
@@ -0,0 +1,218 @@
+# 3rd-party libs
+import pytz
+
+# Standard libs
+import datetime, functools
+
+
+# (minimum, maximum, names) of each field of a cron expression
+FIELDS = (
+    (0, 59, None), # minute
+    (0, 23, None), # hour
+    (1, 31, None), # day of month
+    (1, 12, ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')), # month
+    (0, 7, ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')), # day of week (0 and 7 are Sunday)
+)
+
+# how far we look for an occurrence before saying the expression never matches
+MAX_YEARS = 8
+
+
+class Cron():
+    """
+    Compiled cron expression ("30 11 */5 */2 *").
+    Each field is stored as a bitset (bit n is set if value n matches), so that the
+    next matching value of a field is found with a few integer operations.
+    """
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("A cron expression has 5 fields")
+
+        self.expression = ' '.join(fields)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (_parse_field(field, *FIELDS[i]) for i, field in enumerate(fields))
+
+        # Sunday is both 0 and 7
+        if self.weekdays & (1 << 7):
+            self.weekdays = (self.weekdays | 1) & ~(1 << 7)
+
+        # like in Vixie cron, if both day fields are restricted, a day matches if either matches
+        self.days_any = fields[2] == '*'
+        self.weekdays_any = fields[4] == '*'
+
+
+    def match_day(self, date):
+        """
+        Tells if the day of a date matches the day of month and day of week fields.
+
+        Args:
+            date (datetime.datetime): Date to check
+
+        Returns:
+            bool: True if the day matches
+        """
+        day = bool(self.days >> date.day & 1)
+        weekday = bool(self.weekdays >> (date.isoweekday() % 7) & 1)
+
+        if self.days_any and self.weekdays_any:
+            return True
+        elif self.days_any:
+            return weekday
+        elif self.weekdays_any:
+            return day
+        else:
+            return day or weekday
+
+
+    def next_local(self, date):
+        """
+        Returns the first matching minute after a date, in wall-clock time.
+
+        Args:
+            date (datetime.datetime): Naive datetime to start from (excluded)
+
+        Returns:
+            datetime.datetime: Naive datetime of the next occurrence
+        """
+        date = date.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = date.year + MAX_YEARS
+
+        while date.year < limit:
+            # month
+            month = _next_bit(self.months, date.month)
+            if month is None:
+                date = datetime.datetime(date.year+1, _next_bit(self.months, 1), 1)
+                continue
+            if month != date.month:
+                date = datetime.datetime(date.year, month, 1)
+
+            # day
+            if not self.match_day(date):
+                if self.weekdays_any:
+                    day = _next_bit(self.days, date.day)
+                    if day is not None and day <= _month_length(date.year, date.month):
+                        date = datetime.datetime(date.year, date.month, day)
+                        continue
+                    date = _next_month(date)
+                else:
+                    date = datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(days=1)
+                continue
+
+            # hour
+            hour = _next_bit(self.hours, date.hour)
+            if hour is None:
+                date = datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(days=1)
+                continue
+            if hour != date.hour:
+                date = date.replace(hour=hour, minute=0)
+
+            # minute
+            minute = _next_bit(self.minutes, date.minute)
+            if minute is None:
+                date = date.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            return date.replace(minute=minute)
+
+        raise ValueError(f"Cron expression {self.expression} never matches")
+
+
+    def next(self, date, timezone='UTC'):
+        """
+        Returns the next occurrence after a date, following the wall clock of a timezone.
+
+        Args:
+            date (datetime.datetime): Aware datetime to start from (excluded)
+            timezone (str or pytz.tzinfo, optional): IANA timezone. Defaults to 'UTC'.
+
+        Returns:
+            datetime.datetime: Aware datetime (UTC) of the next occurrence
+        """
+        tz = timezone if isinstance(timezone, datetime.tzinfo) else pytz.timezone(timezone or 'UTC')
+        local = date.astimezone(tz).replace(tzinfo=None)
+
+        while True:
+            local = self.next_local(local)
+            # times skipped by a DST change are shifted by normalize() after the change
+            result = tz.normalize(tz.localize(local)).astimezone(datetime.timezone.utc)
+            if result > date:
+                return result
+
+
+@functools.lru_cache(maxsize=4096)
+def compile(expression):
+    """
+    Compiles a cron expression. Results are cached per expression.
+
+    Args:
+        expression (str): Cron expression ("0 8 * * 1")
+
+    Returns:
+        Cron: Compiled expression
+    """
+    return Cron(expression)
+
+
+def next_fire(expression, date, timezone='UTC'):
+    """
+    Returns the next occurrence of a cron expression after a date.
+
+    Args:
+        expression (str): Cron expression ("0 8 * * 1")
+        date (datetime.datetime): Aware datetime to start from (excluded)
+        timezone (str or pytz.tzinfo, optional): IANA timezone the expression is written in. Defaults to 'UTC'.
+
+    Returns:
+        datetime.datetime: Aware datetime (UTC) of the next occurrence
+    """
+    return compile(' '.join(expression.split())).next(date, timezone)
+
+
+def _parse_field(field, minimum, maximum, names):
+    mask = 0
+    for part in field.lower().split(','):
+        range_part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError(f"Invalid step in {field}")
+
+        if range_part == '*':
+            start, end = minimum, maximum
+        else:
+            start, _, end = range_part.partition('-')
+            start = _parse_value(start, minimum, names)
+            # "5/10" means from 5 to the maximum, every 10
+            end = _parse_value(end, minimum, names) if end else (maximum if step > 1 else start)
+
+        if not minimum <= start <= end <= maximum:
+            raise ValueError(f"Value out of range in {field}")
+
+        for value in range(start, end+1, step):
+            mask |= 1 << value
+    return mask
+
+
+def _parse_value(value, minimum, names):
+    if names is not None and value in names:
+        return names.index(value) + minimum
+    return int(value)
+
+
+def _next_bit(mask, start):
+    """
+    Returns the position of the lowest bit set in mask at or after start, or None.
+    """
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
+
+
+def _month_length(year, month):
+    return (_next_month(datetime.datetime(year, month, 1)) - datetime.timedelta(days=1)).day
+
+
+def _next_month(date):
+    if date.month == 12:
+        return datetime.datetime(date.year+1, 1, 1)
+    return datetime.datetime(date.year, date.month+1, 1)
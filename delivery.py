@@ -0,0 +1,274 @@
+# Project libs
+from cache import LRUCache
+from configs import config, log
+import history, metrics
+
+# 3rd-party libs
+import discord
+
+# Standard libs
+import asyncio, collections, time
+
+
+# Embeds that can be sent in one message (limit of Discord)
+MAX_EMBEDS = 10
+
+
+class Dispatcher():
+    """
+    Delivery queue for fired reminders.
+    A bounded pool of workers sends the reminders concurrently; discord.py takes care
+    of waiting for the global and per-route rate limits, and the workers retry the
+    sends that still fail, with an exponential backoff.
+
+    With coalesce, reminders fired at the same time for the same user are sent together,
+    as one message with several embeds; if that message fails, they are sent one by one.
+
+    Outcomes are added to the history buffer, if there is one (see history.py).
+    """
+    def __init__(self, client, workers=8, retries=3, backoff=2, coalesce=True, history=None):
+        self.client = client
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce = coalesce
+        self.history = history
+        self.queue = asyncio.Queue() # (author, [(reminder_id, embed, due), ...], batch or None)
+        self.tasks = []
+        self.outcomes = collections.Counter() # outcome -> count
+
+
+    def start(self):
+        """
+        Starts the workers.
+        """
+        for _ in range(self.workers - len(self.tasks)):
+            self.tasks.append(self.client.loop.create_task(self.worker()))
+
+
+    def submit(self, reminder_id, author, embed, due=None):
+        """
+        Puts a reminder in the delivery queue.
+
+        Args:
+            reminder_id (int): Reminder ID
+            author (int): Snowflake of the user to send the reminder to
+            embed (discord.Embed): Content of the reminder
+            due (int, optional): Timestamp the reminder was due at, to measure how late it is delivered
+        """
+        self.queue.put_nowait((author, [(reminder_id, embed, due)], None))
+        metrics.delivery_queue.set(self.queue.qsize())
+
+
+    def submit_all(self, deliveries):
+        """
+        Puts reminders fired together in the delivery queue.
+        With coalesce, the reminders of a same user are grouped, up to MAX_EMBEDS per message.
+
+        Args:
+            deliveries (list): (reminder_id, author, embed, due) tuples (see submit)
+
+        Returns:
+            asyncio.Future: Done once every reminder given has been processed (sent, or given up)
+        """
+        if self.coalesce:
+            groups = {} # author -> [(reminder_id, embed, due), ...]
+            for reminder_id, author, embed, due in deliveries:
+                groups.setdefault(author, []).append((reminder_id, embed, due))
+            entries = [(author, group[i:i+MAX_EMBEDS]) for author, group in groups.items() for i in range(0, len(group), MAX_EMBEDS)]
+        else:
+            entries = [(author, [(reminder_id, embed, due)]) for reminder_id, author, embed, due in deliveries]
+
+        done = asyncio.get_running_loop().create_future()
+        if not entries:
+            done.set_result(None)
+        batch = [len(entries), done] # entries not processed yet, future
+        for author, group in entries:
+            self.queue.put_nowait((author, group, batch))
+        metrics.delivery_queue.set(self.queue.qsize())
+        return done
+
+
+    async def join(self):
+        """
+        Waits until every reminder in the queue has been processed.
+        """
+        await self.queue.join()
+
+
+    async def worker(self):
+        while True:
+            author, group, batch = await self.queue.get()
+            metrics.delivery_queue.set(self.queue.qsize())
+            try:
+                if len(group) == 1:
+                    reminder_id, embed, due = group[0]
+                    await self.deliver(reminder_id, author, embed, due)
+                else:
+                    await self.deliver_group(author, group)
+            except Exception as e:
+                for reminder_id, _, due in group:
+                    self.record(reminder_id, 'error', author, due)
+                log.error(f'Uncaught exception while delivering reminders {[reminder_id for reminder_id, _, _ in group]}: {e}', exc_info=True)
+            finally:
+                self.queue.task_done()
+                if batch is not None:
+                    batch[0] -= 1
+                    if batch[0] == 0 and not batch[1].done():
+                        batch[1].set_result(None)
+
+
+    async def deliver(self, reminder_id, author, embed, due=None):
+        """
+        Sends a reminder to its author, retrying if Discord fails.
+
+        Args:
+            reminder_id (int): Reminder ID
+            author (int): Snowflake of the user to send the reminder to
+            embed (discord.Embed): Content of the reminder
+            due (int, optional): Timestamp the reminder was due at
+        """
+        for attempt in range(self.retries+1):
+            try:
+                user = await self.user(author)
+                start = time.perf_counter()
+                await user.send(embed=embed)
+                metrics.discord_seconds.observe(time.perf_counter() - start, 'send')
+            except (discord.Forbidden, discord.NotFound) as e:
+                # user left, or does not accept DMs anymore: retrying will not help
+                users.pop(author)
+                self.record(reminder_id, 'refused', author, due)
+                log.warning(f"Reminder {reminder_id} could not be delivered: {e}")
+                return
+            except (discord.HTTPException, OSError) as e:
+                if attempt == self.retries:
+                    self.record(reminder_id, 'failed', author, due)
+                    log.error(f"Reminder {reminder_id} could not be delivered after {attempt+1} attempts: {e}")
+                    return
+                delay = self.backoff * 2**attempt
+                log.warning(f"Reminder {reminder_id} delivery failed ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+            else:
+                self.record(reminder_id, 'delivered', author, due)
+                if due is not None:
+                    metrics.fire_lateness_seconds.observe(max(0, time.time() - due))
+                return
+
+
+    async def deliver_group(self, author, group):
+        """
+        Sends several reminders to their author in one message.
+        If Discord fails, they are sent one by one instead (with retries).
+
+        Args:
+            author (int): Snowflake of the user to send the reminders to
+            group (list): (reminder_id, embed, due) tuples, at most MAX_EMBEDS
+        """
+        try:
+            user = await self.user(author)
+            start = time.perf_counter()
+            await user.send(embeds=[embed for _, embed, _ in group])
+            metrics.discord_seconds.observe(time.perf_counter() - start, 'send')
+        except (discord.Forbidden, discord.NotFound) as e:
+            users.pop(author)
+            for reminder_id, _, due in group:
+                self.record(reminder_id, 'refused', author, due)
+            log.warning(f"Reminders {[reminder_id for reminder_id, _, _ in group]} could not be delivered: {e}")
+        except (discord.HTTPException, OSError) as e:
+            log.warning(f"Grouped delivery of reminders {[reminder_id for reminder_id, _, _ in group]} failed ({e}), sending them one by one")
+            for reminder_id, embed, due in group:
+                await self.deliver(reminder_id, author, embed, due)
+        else:
+            for reminder_id, _, due in group:
+                self.record(reminder_id, 'delivered', author, due)
+                if due is not None:
+                    metrics.fire_lateness_seconds.observe(max(0, time.time() - due))
+
+
+    async def user(self, author):
+        """
+        Returns the user object of someone, from the cache if possible.
+
+        Args:
+            author (int): Snowflake of the user
+
+        Returns:
+            discord.User: User object
+        """
+        user = users.get(author)
+        if user is None:
+            # do not ask me why I have to use fetch instead of get here...
+            # probably because get is relying on cache, so requires the bot to be in a guild? idk
+            start = time.perf_counter()
+            user = await self.client.fetch_user(author)
+            metrics.discord_seconds.observe(time.perf_counter() - start, 'fetch_user')
+            users.put(author, user)
+        return user
+
+
+    def record(self, reminder_id, outcome, author=None, due=None):
+        """
+        Records the outcome of a delivery.
+
+        Args:
+            reminder_id (int): Reminder ID
+            outcome (str): "delivered", "refused", "failed" or "error"
+            author (int, optional): Snowflake of the user the reminder was sent to
+            due (int, optional): Timestamp the reminder was due at
+        """
+        self.outcomes[outcome] += 1
+        metrics.deliveries.inc(outcome)
+        log.debug("Reminder %s delivery: %s", reminder_id, outcome)
+        if self.history is not None:
+            self.history.add(reminder_id, author, due, outcome)
+
+
+def embed(reminder, next, occurrences=1, late=False):
+    """
+    Builds the message of a fired reminder.
+
+    Args:
+        reminder (models.Reminder): Reminder
+        next (datetime.datetime): Next occurrence of the reminder, None if there is none
+        occurrences (int, optional): How many occurrences this message covers. Defaults to 1.
+        late (bool, optional): If the reminder is sent late (the bot was not running). Defaults to False.
+
+    Returns:
+        discord.Embed: Embed object
+    """
+    content = discord.Embed(title='Reminder!', description=reminder.text, color=discord.Colour(reminder.color))
+    content.add_field(name='Added on', value=f'<t:{reminder.date_creation}>', inline=True)
+    if late:
+        content.add_field(name='Was due on', value=f'<t:{reminder.date_next}>', inline=True)
+    if occurrences > 1:
+        content.add_field(name='Missed occurrences', value=str(occurrences-1), inline=True)
+    if next:
+        content.add_field(name='Next occurrence on', value=f'<t:{int(next.timestamp())}>', inline=True)
+    return content
+
+
+# User objects of the people we recently talked with, to avoid fetching them on each reminder.
+# Filled by incoming messages and by fetches.
+_settings = config.get('delivery') or {}
+users = LRUCache(maxsize=_settings.get('users_cache_size', 10000), ttl=_settings.get('users_cache_ttl', 3600))
+
+
+def dispatcher(client):
+    """
+    Creates a dispatcher configured from the "delivery" section of the config file.
+
+    Args:
+        client (discord.Client): Discord client object
+
+    Returns:
+        Dispatcher: Dispatcher object (not started)
+    """
+    settings = config.get('delivery') or {}
+    return Dispatcher(
+        client,
+        workers=settings.get('workers', 8),
+        retries=settings.get('retries', 3),
+        backoff=settings.get('backoff', 2),
+        coalesce=settings.get('coalesce', True),
+        history=history.buffer()
+    )
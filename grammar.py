@@ -0,0 +1,114 @@
+# Standard libs
+import collections, re
+
+
+# Duration expression: "1n 2w 3d 4h 5m" (each unit is optional, but they must come in this order)
+_UNITS = r'(?:\s[0-9]+(?:M|n))?(?:\s[0-9]+w)?(?:\s[0-9]+d)?(?:\s[0-9]+h)?(?:\s[0-9]+m)?'
+
+# Tolerance: "~2m", "~1h" (how much earlier or later the reminder may be sent)
+_TOLERANCE = r'(?:\s~(?P<tolerance>[0-9]+[hm]))?'
+
+# Time of day: "19", "19h", "19:30", "19h30", "1930"
+_TIME = r'(?P<{0}hour>[0-9]{{1,2}})(?:h?|(?:h|:)?(?P<{0}minute>[0-9]{{1,2}}))'
+
+# All the variants of the reminder commands, in one expression compiled once.
+# Group names are prefixed by the command, as they must be unique.
+REMINDER = re.compile(
+    r'^(?:'
+    rf'in(?P<in_timepoint>{_UNITS})'
+    rf'|at\s{_TIME.format("at_")}'
+    rf'|on\s(?P<on_day>[0-9]{{1,2}})(?:\sat\s{_TIME.format("on_")})?'
+    rf')(?:\severy(?P<recurrence>{_UNITS}))?{_TOLERANCE},(?P<text>.*)$'
+)
+
+CRON = re.compile(r'^cron\s+(?P<expression>(?:[^\s~]\S*\s+){4}[^\s~]\S*)(?:\s+~(?P<tolerance>[0-9]+[hm]))?\s*,(?P<text>.*)$')
+
+REMOVE = re.compile(r'^(?:remove|rm|delete|del) ([0-9]+)$')
+
+
+# Parsed reminder command.
+# kind: "in" (relative), "at" (time of the day) or "on" (day of the month)
+# timepoint: for "in", duration expression ("3h 5m"); day, hour, minute: for "at" and "on" (None when not given)
+# recurrence: duration expression of the "every" clause, or None; text: reminder text
+# tolerance: seconds the reminder may be sent earlier or later ("~" clause), or None
+Spec = collections.namedtuple('Spec', ('kind', 'timepoint', 'day', 'hour', 'minute', 'recurrence', 'text', 'tolerance'), defaults=(None,))
+
+
+def parse_reminder(message):
+    """
+    Parses an "in", "at" or "on" command.
+
+    Args:
+        message (str): Message content
+
+    Returns:
+        Spec: Parsed command, or None if the syntax is wrong
+    """
+    match = REMINDER.match(message)
+    if match is None:
+        return None
+    g = match.groupdict()
+
+    recurrence = g['recurrence']
+    if recurrence is not None:
+        recurrence = recurrence.strip()
+        if not recurrence: # "every" without any duration
+            return None
+        if not any(int(block[:-1]) for block in recurrence.split()): # "every 0m" would never move forward
+            return None
+
+    text = g['text'].strip()
+    tolerance = _seconds(g['tolerance'])
+
+    if g['in_timepoint'] is not None:
+        timepoint = g['in_timepoint'].strip()
+        if not timepoint:
+            return None
+        return Spec('in', timepoint, None, None, None, recurrence, text, tolerance)
+
+    if g['at_hour'] is not None:
+        return Spec('at', None, None, int(g['at_hour']), _int(g['at_minute']), recurrence, text, tolerance)
+
+    return Spec('on', None, int(g['on_day']), _int(g['on_hour']), _int(g['on_minute']), recurrence, text, tolerance)
+
+
+def parse_cron(message):
+    """
+    Parses a "cron" command.
+
+    Args:
+        message (str): Message content
+
+    Returns:
+        tuple: (cron expression, reminder text, tolerance in seconds or None), or None if the syntax is wrong
+    """
+    match = CRON.match(message)
+    if match is None:
+        return None
+    return ' '.join(match.group('expression').split()), match.group('text').strip(), _seconds(match.group('tolerance'))
+
+
+def parse_remove(message):
+    """
+    Parses a "remove" command.
+
+    Args:
+        message (str): Message content
+
+    Returns:
+        int: ID of the reminder to remove, or None if the syntax is wrong
+    """
+    match = REMOVE.match(message)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _seconds(tolerance):
+    if tolerance is None:
+        return None
+    return int(tolerance[:-1]) * (3600 if tolerance[-1] == 'h' else 60)
@@ -0,0 +1,204 @@
+"""
+History of the deliveries, when enabled in the config file.
+The outcome of every delivery is appended to the "deliveries" table, so that fired reminders
+can be audited even though one-shot reminders are deleted from the "reminders" table
+(which only holds the pending ones). Outcomes are buffered and written in batches.
+
+A background job keeps the database in shape, without holding up the fire loop and the commands:
+it deletes the history older than the retention and gives the freed pages back to the file system,
+both by small chunks, then refreshes the statistics of the query planner with ANALYZE.
+
+Latest deliveries, or maintenance, from the command line:
+```
+python history.py [--author ID] [--limit 20]
+python history.py --maintain
+```
+"""
+
+# Project libs
+from configs import config, log
+import models
+
+# Standard libs
+import argparse, asyncio, datetime, time
+
+
+# Rows deleted at once when pruning the history
+PRUNE_CHUNK = 5000
+
+# Pages given back to the file system at once
+VACUUM_CHUNK = 1000
+
+
+def settings():
+    return config.get('history') or {}
+
+
+class History():
+    """
+    Buffer of delivery outcomes, waiting to be written in the "deliveries" table.
+    The writer (see keep) is woken up early when a batch is full.
+    """
+    def __init__(self, batch=500):
+        self.batch = batch
+        self.rows = [] # (reminder, author, date_due, date_sent, outcome)
+        self.full = asyncio.Event()
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def add(self, reminder_id, author, due, outcome):
+        """
+        Adds the outcome of a delivery to the buffer.
+
+        Args:
+            reminder_id (int): Reminder ID
+            author (int): Snowflake of the user the reminder was sent to
+            due (int): Timestamp the reminder was due at, None if unknown
+            outcome (str): "delivered", "refused", "failed" or "error"
+        """
+        self.rows.append((reminder_id, author, due, int(time.time()), outcome))
+        if len(self.rows) >= self.batch:
+            self.full.set()
+
+
+    def take(self):
+        """
+        Empties the buffer.
+
+        Returns:
+            list: Rows that were in the buffer
+        """
+        rows, self.rows = self.rows, []
+        self.full.clear()
+        return rows
+
+
+    async def flush(self, db):
+        """
+        Writes the buffered outcomes in the database.
+        If writing fails, they are put back in the buffer, to be written next time.
+
+        Args:
+            db (models.AsyncDatabase): Database instance
+        """
+        rows = self.take()
+        if rows:
+            try:
+                await db.insert_deliveries(rows)
+            except Exception:
+                self.rows[:0] = rows
+                raise
+
+
+def buffer():
+    """
+    Creates a buffer configured from the "history" section of the config file.
+
+    Returns:
+        History: History object, or None if the history is disabled
+    """
+    if not settings().get('enabled', True):
+        return None
+    return History(batch=settings().get('batch', 500))
+
+
+async def maintain(db, now=None):
+    """
+    Deletes the history older than the retention, then compacts the database and refreshes its statistics.
+    Work is done by chunks, letting the other queries run in between.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        now (float, optional): Timestamp of reference. Defaults to current time.
+
+    Returns:
+        int: Number of deliveries deleted
+        int: Number of pages given back to the file system
+    """
+    if now is None:
+        now = time.time()
+    retention = settings().get('retention', 90)
+
+    pruned = 0
+    if retention:
+        before = int(now - retention*86400)
+        while True:
+            count = await db.prune_deliveries(before, PRUNE_CHUNK)
+            pruned += count
+            if count < PRUNE_CHUNK:
+                break
+            await asyncio.sleep(0) # letting the commands run between chunks
+
+    vacuumed = 0
+    while True:
+        count = await db.vacuum(VACUUM_CHUNK)
+        vacuumed += count
+        if count < VACUUM_CHUNK:
+            break
+        await asyncio.sleep(0)
+
+    await db.analyze()
+    return pruned, vacuumed
+
+
+async def keep(db, history=None):
+    """
+    Background job writing the buffered outcomes every "interval" seconds (or once a batch is full),
+    and maintaining the database every "maintenance" seconds.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        history (History, optional): Buffer to write. Defaults to none (maintenance only).
+    """
+    interval = settings().get('interval', 10)
+    maintenance = settings().get('maintenance', 86400)
+    next_maintenance = time.monotonic() + maintenance
+    while True:
+        # an error (database locked by another process...) must not stop the job
+        try:
+            if history is not None:
+                try:
+                    await asyncio.wait_for(history.full.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+                await history.flush(db)
+            else:
+                await asyncio.sleep(max(0, next_maintenance - time.monotonic()))
+
+            if time.monotonic() >= next_maintenance:
+                next_maintenance = time.monotonic() + maintenance # not retried right away if it fails
+                start = time.perf_counter()
+                pruned, vacuumed = await maintain(db)
+                log.info("Database maintained in %.3fs: %s deliveries pruned, %s pages given back", time.perf_counter() - start, pruned, vacuumed)
+        except Exception as e:
+            log.error(f'Uncaught exception in the history job: {e}', exc_info=True)
+            await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="History of the deliveries")
+    parser.add_argument('--author', type=int, help="only the deliveries to this user")
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--maintain', action='store_true', help="prune the history and maintain the database now, instead of listing")
+    args = parser.parse_args()
+
+    async def main():
+        db = models.AsyncDatabase()
+        if args.maintain:
+            start = time.perf_counter()
+            pruned, vacuumed = await maintain(db)
+            print(f'{pruned} deliveries pruned, {vacuumed} pages given back in {time.perf_counter() - start:.1f}s')
+            return
+
+        for reminder, author, due, sent, outcome in await db.select_deliveries(args.author, args.limit):
+            due = '?' if due is None else f'{datetime.datetime.fromtimestamp(due):%Y-%m-%d %H:%M:%S}'
+            print(f'{datetime.datetime.fromtimestamp(sent):%Y-%m-%d %H:%M:%S}  reminder {reminder}  to {author}  due {due}  {outcome}')
+
+    try:
+        asyncio.run(main())
+    finally:
+        models.AsyncDatabase.shutdown()
+        models.Database.close()
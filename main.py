@@ -1,12 +1,20 @@
 # Project libs
 from configs import config, log
-import commands, models, utils
+import admission, commands, delivery, history, metrics, models, occurrences, utils, worker
+from scheduler import timeline
 
 # 3rd-party libs
 import discord
 
 # Standard libs
-import asyncio, sys
+import asyncio, datetime, sys, time
+
+
+# Seconds after which the author is shown that we are typing, if the command is not done yet
+TYPING_DELAY = 0.5
+
+# Seconds given to the delivery queue to be sent when stopping
+SHUTDOWN_TIMEOUT = 30
 
 
 # ------------------------------------- #
@@ -17,6 +25,32 @@ class Client(discord.Client):
     """
     Discord client class
     """
+    async def setup_hook(self):
+        await metrics.serve()
+
+        # Reminders are fired by worker processes
+        if self.workers:
+            self.loop.create_task(worker.supervise(self.workers))
+
+        # Upcoming occurrences are computed in advance
+        if occurrences.enabled():
+            self.loop.create_task(occurrences.keep(models.AsyncDatabase()))
+
+        # Delivery history is written in batches, and the database is maintained in the background
+        self.loop.create_task(history.keep(models.AsyncDatabase(), self.dispatcher.history))
+
+    async def close(self):
+        # reminders waiting in the delivery queue are sent (and their fate saved) before disconnecting;
+        # the ones still not sent after the timeout are fired again at next start
+        if self.dispatcher.tasks:
+            try:
+                await asyncio.wait_for(self.dispatcher.join(), SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning(f'{self.dispatcher.queue.qsize()} deliveries still waiting after {SHUTDOWN_TIMEOUT}s, stopping anyway')
+            if self.settling:
+                await asyncio.wait(self.settling, timeout=SHUTDOWN_TIMEOUT)
+        await super().close()
+
     async def on_ready(self):
         pyversion = sys.version.replace('\n', ' ')
         print('Connected!')
@@ -30,19 +64,35 @@ class Client(discord.Client):
         log.info(f'Python version: {pyversion}')
         log.info(f'discord.py version: {discord.__version__}')
 
-        # Creating the fetch loop
-        self.loop.create_task(loop(self))
+        # Creating the fetch loop (unless worker processes do the job)
+        if not self.workers:
+            self.loop.create_task(loop(self))
 
     # DMs only
     async def on_message(self, payload):
-        # do not reply to yourself, silly
-        if payload.author.id == self.user.id:
+        # only DMs from people: do not reply to yourself (silly) or to other bots
+        if payload.author.id == self.user.id or payload.author.bot or payload.guild is not None:
+            return None
+
+        # Admission control, before any I/O: spamming users get one notice, then are ignored for a while
+        if self.gate is not None:
+            decision = self.gate.admit(payload.author.id)
+            if decision == admission.NOTICE:
+                await utils.notify('error_rateLimited', payload.author)
+            if decision != admission.ADMIT:
+                return None
+
+        delivery.users.put(payload.author.id, payload.author)
+
+        # Not a command: the reply is prerendered
+        if commands.command_name(payload.content) is None:
+            await utils.notify('error_unrecognizedCommand', payload.author)
             return None
 
-        log.debug(payload)
+        log.debug("Command from %s: %s", payload.author.id, payload.content)
 
-        # Give an indication to the author
-        await payload.channel.typing()
+        # Give an indication to the author, only if the command takes some time
+        typing = self.loop.call_later(TYPING_DELAY, lambda: asyncio.ensure_future(indicate_typing(payload.channel)))
 
         # Main handler
         try:
@@ -50,6 +100,15 @@ class Client(discord.Client):
         except Exception as e:
             await utils.notify('error_general', payload.author)
             log.error(f'Uncaught exception: {e}', exc_info=True)
+        finally:
+            typing.cancel()
+
+
+async def indicate_typing(channel):
+    try:
+        await channel.typing()
+    except discord.HTTPException: # only an indication
+        pass
 
 
 # ------------------------------------- #
@@ -58,53 +117,174 @@ class Client(discord.Client):
 
 async def loop(client):
     """
-    Loop that regularly looks for reminders to be sent.
+    Loop that fires reminders when they are due.
+    It sleeps until the first reminder of the timeline is due, and is woken up early
+    if a command adds a reminder that has to be sent before.
+    Fired reminders are handed over to the dispatcher, which sends them concurrently.
 
     Args:
         client (discord.Client): Discord client object
     """
     await client.wait_until_ready()
+    client.dispatcher.start()
+    db = models.AsyncDatabase()
+    timeline.load(await db.select_reminders_schedule())
+    try:
+        await catch_up(client, db)
+    except Exception as e:
+        log.error(f'Uncaught exception while catching up: {e}', exc_info=True)
     previous_count = -1
+    next_report = 0
     while True:
-        await asyncio.sleep(40)
-        log.debug("Event loop begins")
+        # an error must not stop the firing of the other reminders
+        try:
+            # prevent sending useless requests
+            count = len(timeline)
+            metrics.scheduled_reminders.set(count)
+            if time.time() >= next_report:
+                next_report = time.time() + 60
+                metrics.peak_minute_reminders.set(max(timeline.histogram(int(time.time()) // 60 * 60, 60)))
+            if count == 0 and previous_count != 0:
+                await client.change_presence(status=discord.Status.idle)
+            elif count != 0 and previous_count == 0:
+                await client.change_presence(status=discord.Status.online)
+            previous_count = count
+
+            if not await timeline.wait():
+                continue
+            await tick(client, db)
+        except Exception as e:
+            log.error(f'Uncaught exception in the fire loop: {e}', exc_info=True)
+            await asyncio.sleep(1) # not retrying in a tight loop if the error persists
+
+
+@metrics.tick_seconds.time()
+async def tick(client, db):
+    """
+    Fires the reminders that are due now.
+
+    Args:
+        client (discord.Client): Discord client object
+        db (models.AsyncDatabase): Database instance
+    """
+    log.debug("Event loop begins")
+
+    # Getting reminders that are happening now (or within their tolerance window)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    reminders = await db.select_reminders_ids(timeline.pop_due(now.timestamp()))
+    if not reminders:
+        return
+
+    horizon = await occurrences.horizon(db, reminders)
+    nexts, counts, deleted, updated = utils.fates(reminders, now, horizon)
+    utils.reschedule(reminders, deleted, updated)
 
-        # Getting reminders that are happening now
-        db = models.Database()
-        count = db.count_reminders()
-        reminders = db.select_reminders_now()
+    deliveries = []
+    for reminder in reminders:
+        log.info("Reminder %s fired!", reminder.id)
+        content = delivery.embed(reminder, nexts[reminder.id], counts[reminder.id])
+        deliveries.append((reminder.id, reminder.author, content, reminder.date_next))
+    settle(client, db, client.dispatcher.submit_all(deliveries), deleted, updated, horizon)
+
+
+def settle(client, db, sent, deleted, updated, horizon):
+    """
+    Saves the fate of fired reminders in the database once they have been sent, in the background.
+    Until then, they are still due in the database: if the bot stops before sending them, they are fired again at next start.
 
-        for reminder in reminders:
-            log.info(f"Reminder {reminder['id']} fired!")
+    Args:
+        client (discord.Client): Discord client object
+        db (models.AsyncDatabase): Database instance
+        sent (asyncio.Future): Done once the reminders have been sent, as returned by Dispatcher.submit_all
+        deleted (list): IDs of the reminders to delete
+        updated (list): (id, date_next, recurrence_limit) tuples of the reminders to reschedule
+        horizon (dict): Materialized occurrences of the reminders, None if they are not materialized
 
-            # do not ask me why I have to use fetch instead of get here...
-            # probably because get is relying on cache, so requires the bot to be in a guild? idk
-            user = await client.fetch_user(reminder["author"])
-            next = utils.reminder_fate(db, reminder["id"])
+    Returns:
+        asyncio.Task: Task saving the fate
+    """
+    async def save():
+        await sent
+        try:
+            await db.apply_reminders_fate(deleted, updated, horizon is not None)
+        except Exception as e:
+            log.error(f'Uncaught exception while saving the fate of reminders {deleted + [id for id, _, _ in updated]}: {e}', exc_info=True)
 
-            content = discord.Embed(title='Reminder!', description=reminder["text"], color=discord.Colour(reminder["color"]))
-            content.add_field(name='Added on', value=f'<t:{reminder["date_creation"]}>', inline=True)
-            if next:
-                content.add_field(name='Next occurrence on', value=f'<t:{int(next.timestamp())}>', inline=True)
-            await user.send(embed=content)
+    task = client.loop.create_task(save())
+    client.settling.add(task)
+    task.add_done_callback(client.settling.discard)
+    return task
 
-        # prevent sending useless requests
-        if count == 0 and previous_count != 0:
-            await client.change_presence(status=discord.Status.idle)
-        elif count != 0 and previous_count == 0:
-            await client.change_presence(status=discord.Status.online)
-        previous_count = count
+
+async def catch_up(client, db):
+    """
+    Fires the reminders that were missed while the bot was not running.
+    All the missed occurrences of a recurring reminder are sent as one notification,
+    and the notifications are handed over to the dispatcher at a limited rate,
+    so that a long downtime does not turn into a burst of messages.
+
+    Args:
+        client (discord.Client): Discord client object
+        db (models.AsyncDatabase): Database instance
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    reminders = await db.select_reminders_now(now)
+    if not reminders:
+        return
+
+    log.notice("Catching up %s missed reminders", len(reminders))
+    # they are fired here, not by the loop
+    for reminder in reminders:
+        timeline.discard(reminder.id)
+
+    async def spread():
+        rate = max(1, int((config.get('delivery') or {}).get('catch_up_rate', 10))) # at least one reminder per second
+        try:
+            # by chunks of one second: the fate of a chunk is saved once it is sent, so that
+            # if the bot stops meanwhile, the reminders not sent yet are still missed at next start
+            for i in range(0, len(reminders), rate):
+                start = time.monotonic()
+                chunk = reminders[i:i+rate]
+                horizon = await occurrences.horizon(db, chunk)
+                nexts, counts, deleted, updated = utils.fates(chunk, horizon=horizon)
+                utils.reschedule(chunk, deleted, updated)
+                deliveries = [(reminder.id, reminder.author, delivery.embed(reminder, nexts[reminder.id], counts[reminder.id], late=True), None) for reminder in chunk]
+                await settle(client, db, client.dispatcher.submit_all(deliveries), deleted, updated, horizon)
+                await asyncio.sleep(max(0, 1 - (time.monotonic() - start)))
+        except Exception as e:
+            log.error(f'Uncaught exception while catching up: {e}', exc_info=True)
+            return
+        log.notice("Catch-up finished")
+
+    client.loop.create_task(spread())
 
 
 # ------------------------------------- #
 # Putting it all together               #
 # ------------------------------------- #
 
-# Setting up and running client
-intents = discord.Intents(dm_messages=True)
-client = Client(intents=intents, status=discord.Status.online)
+if __name__ == '__main__':
+    # Setting up and running client
+    intents = discord.Intents(dm_messages=True)
+    client = Client(intents=intents, status=discord.Status.online)
+    client.dispatcher = delivery.dispatcher(client)
+    client.gate = admission.gate()
+    client.settling = set() # tasks saving the fate of reminders being sent (see settle)
+    client.workers = worker.settings().get('workers', 0)
+    if client.workers:
+        timeline.enabled = False
+    timeline.tolerance = (config.get('delivery') or {}).get('tolerance', 0)
+
+    # Compiling reply templates
+    utils.load_templates()
 
-# Creating the DB if it does not exist yet
-db = models.Database()
+    # Creating the DB if it does not exist yet
+    db = models.Database()
+    for query, plan in db.check_query_plans():
+        log.warning(f'Query is not using its index: "{query}" ({plan})')
 
-client.run(config['token'])
+    client.run(config['token'])
+    models.AsyncDatabase.shutdown() # the database thread is done before the connection is used from here
+    if client.dispatcher.history is not None:
+        models.Database().insert_deliveries(client.dispatcher.history.take())
+    models.Database.close()
@@ -0,0 +1,198 @@
+# Project libs
+from configs import config, log
+
+# Standard libs
+import asyncio, bisect, functools, threading, time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LATENESS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+registry = []
+
+
+class Metric():
+    """
+    Base class of the metrics. Values are kept per tuple of label values.
+    Some metrics are written from the database thread while they are exposed from the event loop:
+    values are changed, and copied to be exposed, while holding the lock of the metric.
+    """
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+
+    def expose(self):
+        """
+        Returns the metric in Prometheus text format.
+
+        Returns:
+            str: Lines describing the metric
+        """
+        with self.lock:
+            values = [(labels, self.copy(value)) for labels, value in self.values.items()]
+
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in sorted(values):
+            lines.extend(self.samples(self._labels(labels), value))
+        return '\n'.join(lines)
+
+
+    def copy(self, value):
+        return value
+
+
+    def samples(self, labels, value):
+        return [f'{self.name}{labels} {value}']
+
+
+    def _labels(self, values):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+
+    def observe(self, value, *labels):
+        """
+        Records a value.
+
+        Args:
+            value (float): Value (usually a duration in seconds)
+            *labels (str): Label values, in the order of the labels of the metric
+        """
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets)+1), 0.0, 0] # counts per bucket, sum, count
+            state[0][bucket] += 1
+            state[1] += value
+            state[2] += 1
+
+
+    def time(self, *labels):
+        """
+        Decorator recording the duration of a coroutine function.
+
+        Args:
+            *labels (str): Label values
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorator
+
+
+    def copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+    def samples(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulated = 0
+        for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+            cumulated += bucket
+            lines.append(f'{self.name}_bucket{self._labels_with_le(labels, bound)} {cumulated}')
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+    def _labels_with_le(self, labels, bound):
+        le = f'le="{bound}"'
+        return '{' + le + '}' if not labels else labels[:-1] + ',' + le + '}'
+
+
+# Fire loop
+tick_seconds = Histogram('boomerang_tick_seconds', "Duration of a fire loop iteration")
+scheduled_reminders = Gauge('boomerang_scheduled_reminders', "Reminders waiting in the scheduler timeline")
+peak_minute_reminders = Gauge('boomerang_peak_minute_reminders', "Most reminders to fire in one of the coming 60 minutes")
+delivery_queue = Gauge('boomerang_delivery_queue', "Fired reminders waiting to be sent")
+fire_lateness_seconds = Histogram('boomerang_fire_lateness_seconds', "Delay between the due time of a reminder and its delivery", buckets=LATENESS_BUCKETS)
+deliveries = Counter('boomerang_deliveries_total', "Outcome of the reminder deliveries", ('outcome',))
+upcoming_reminders = Gauge('boomerang_upcoming_reminders', "Reminders to fire in the coming hours, from the materialized occurrences", ('within',))
+
+# Commands, database and Discord
+admissions = Counter('boomerang_messages_total', "Incoming messages, by admission decision", ('decision',))
+command_seconds = Histogram('boomerang_command_seconds', "Duration of the command handlers", ('command',))
+database_seconds = Histogram('boomerang_database_seconds', "Duration of the database methods", ('method',))
+discord_seconds = Histogram('boomerang_discord_seconds', "Duration of the Discord REST calls", ('call',))
+
+
+def expose():
+    """
+    Returns all the metrics in Prometheus text format.
+
+    Returns:
+        str: Metrics
+    """
+    return '\n'.join(metric.expose() for metric in registry) + '\n'
+
+
+async def handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip(): # skipping headers
+            pass
+
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', expose()
+        else:
+            status, body = '404 Not Found', 'Not found\n'
+
+        body = body.encode('utf-8')
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve():
+    """
+    Starts the HTTP endpoint serving /metrics, if enabled in the "metrics" section of the config file.
+    """
+    settings = config.get('metrics') or {}
+    if not settings.get('enabled', False):
+        return
+
+    host, port = settings.get('host', '127.0.0.1'), settings.get('port', 9464)
+    await asyncio.start_server(handle, host, port)
+    log.info(f'Metrics available on http://{host}:{port}/metrics')
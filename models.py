@@ -1,32 +1,228 @@
+# Project libs
+import metrics
+
 # Standard libs
-import datetime, os, sqlite3
+import asyncio, concurrent.futures, datetime, os, sqlite3, time
+
+
+# Schema changes, applied in order on top of the schema created by create_db.
+# The index of the last applied migration is stored in PRAGMA user_version.
+# Never edit a migration that was already released: add a new one instead.
+MIGRATIONS = (
+    # 1: indexes for due reminders and per-user lookups; dropping the ones duplicating primary keys
+    (
+        'DROP INDEX IF EXISTS "i_people_id"',
+        'DROP INDEX IF EXISTS "i_reminders_id"',
+        'CREATE INDEX IF NOT EXISTS "i_reminders_date_next" ON "reminders" ("date_next" ASC)',
+        'CREATE INDEX IF NOT EXISTS "i_reminders_author_date_next" ON "reminders" ("author" ASC, "date_next" ASC)',
+    ),
+    # 2: leases, for worker processes claiming due reminders
+    (
+        'ALTER TABLE "reminders" ADD COLUMN "lease_owner" TEXT',
+        'ALTER TABLE "reminders" ADD COLUMN "lease_until" INTEGER',
+    ),
+    # 3: materialized upcoming occurrences of the recurring reminders (see occurrences.py)
+    (
+        'CREATE TABLE IF NOT EXISTS "occurrences" ("reminder" INTEGER NOT NULL, "date" INTEGER NOT NULL, PRIMARY KEY("reminder", "date")) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS "i_occurrences_date" ON "occurrences" ("date" ASC)',
+    ),
+    # 4: tolerance window of the reminders, in seconds (NULL: default of the config file)
+    (
+        'ALTER TABLE "reminders" ADD COLUMN "tolerance" INTEGER',
+    ),
+    # 5: append-only history of the deliveries (see history.py); date_due is NULL for the catch-up notifications
+    (
+        'CREATE TABLE IF NOT EXISTS "deliveries" ("reminder" INTEGER NOT NULL, "author" INTEGER NOT NULL, "date_due" INTEGER, "date_sent" INTEGER NOT NULL, "outcome" TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS "i_deliveries_date_sent" ON "deliveries" ("date_sent" ASC)',
+        'CREATE INDEX IF NOT EXISTS "i_deliveries_author_date_sent" ON "deliveries" ("author" ASC, "date_sent" ASC)',
+    ),
+)
+
+# Columns of Reminder, in order
+REMINDER_COLUMNS = "reminders.id, reminders.author, reminders.date_creation, reminders.date_next, reminders.recurrence, reminders.recurrence_limit, reminders.text, reminders.color, reminders.tolerance"
+
+# Reminders with the timezone of their author (needed for cron recurrences)
+SELECT_REMINDERS = f"SELECT {REMINDER_COLUMNS}, people.timezone FROM reminders LEFT JOIN people ON people.id = reminders.author"
+
+# Columns of the tables that are exported and imported (see transfer.py)
+COLUMNS = {
+    "people": ("id", "name", "timezone"),
+    "reminders": ("id", "author", "date_creation", "date_next", "recurrence", "recurrence_limit", "text", "color", "tolerance"),
+}
+
+# Queries run on every tick or on every command, with the index they are expected to use
+HOT_QUERIES = (
+    (f"{SELECT_REMINDERS} WHERE date_next <= ?", (0,), "i_reminders_date_next"),
+    (f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE author=? AND (date_next, id) > (?, ?) ORDER BY date_next, id LIMIT ?", (0, 0, 0, 11), "i_reminders_author_date_next"),
+)
+
+
+class Reminder():
+    """
+    A reminder, as returned by the Database methods.
+    Fields are slots, to keep reminders small; they can also be read as keys (reminder["text"]),
+    like the rows of the DB, which is what the templates do.
+    timezone is the timezone of the author, when it was selected with the reminder (None otherwise).
+    """
+    __slots__ = ('id', 'author', 'date_creation', 'date_next', 'recurrence', 'recurrence_limit', 'text', 'color', 'tolerance', 'timezone')
+
+    def __init__(self, id, author, date_creation, date_next, recurrence=None, recurrence_limit=None, text=None, color=None, tolerance=None, timezone=None):
+        self.id = id
+        self.author = author
+        self.date_creation = date_creation
+        self.date_next = date_next
+        self.recurrence = recurrence
+        self.recurrence_limit = recurrence_limit
+        self.text = text
+        self.color = color
+        self.tolerance = tolerance
+        self.timezone = timezone
+
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+    def __repr__(self):
+        return f'<Reminder {self.id} of {self.author} due on {self.date_next}>'
+
+
+def _reminder(cursor, row):
+    # row factory: the columns are the ones of REMINDER_COLUMNS (and the timezone), in order
+    return Reminder(*row)
+
 
 class Database():
     """
     Class representing the database and its methods to interact with it.
+
+    All the instances share the same connection, which is opened on first use and
+    kept for the whole life of the process.
     """
+    path = "data/boomerang.sqlite3"
+    connection = None
+
     def __init__(self):
-        # Checking if the DB already exists; if not, create the schema
-        if not os.path.exists("data/boomerang.sqlite3"):
-            self.create_db()
+        if Database.connection is None:
+            Database.connection = self.connect()
 
-        self.base = sqlite3.connect("data/boomerang.sqlite3")
-        self.base.row_factory = sqlite3.Row # having column names! cf https://stackoverflow.com/a/18788347
+        self.base = Database.connection
         self.cursor = self.base.cursor()
 
 
-    def create_db(self):
+    def connect(self):
+        """
+        Opens the connection shared by all the instances.
+        The schema is created if the DB does not exist yet.
+
+        Returns:
+            sqlite3.Connection: Connection object
+        """
+        # Checking if the DB already exists; if not, create the schema
+        exists = os.path.exists(self.path)
+
+        # statements are compiled once and kept in the connection cache
+        # it is used by the database thread of AsyncDatabase, but never by two threads at the same time
+        base = sqlite3.connect(self.path, cached_statements=256, check_same_thread=False)
+        base.row_factory = sqlite3.Row # having column names! cf https://stackoverflow.com/a/18788347
+
+        # WAL: readers do not wait for writers, and commits only need a fsync at checkpoint time
+        base.execute("PRAGMA journal_mode=WAL")
+        base.execute("PRAGMA synchronous=NORMAL")
+        base.execute("PRAGMA cache_size=-16000") # 16 MB
+        base.execute("PRAGMA mmap_size=268435456") # 256 MB
+        base.execute("PRAGMA temp_store=MEMORY")
+
+        if not exists:
+            self.create_db(base)
+        self.migrate(base)
+
+        # free pages are given back by small steps (see vacuum), which needs auto_vacuum: turning it on rebuilds the file, once
+        if base.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            base.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            base.execute("VACUUM")
+
+        # statistics of the query planner, following the growth of the tables: a sampled ANALYZE takes
+        # the same time whatever their size (stats of small tables make the planner scan big ones)
+        base.execute("PRAGMA analysis_limit=1000")
+        base.execute("ANALYZE")
+
+        return base
+
+
+    @classmethod
+    def close(cls):
         """
-        Function creating the DB if it does not exist
+        Closes the shared connection, if it is open.
+        """
+        if cls.connection is not None:
+            cls.connection.execute("PRAGMA optimize") # statistics of the tables queried, if they changed much
+            cls.connection.close()
+            cls.connection = None
+
+
+    def create_db(self, base):
+        """
+        Function creating the DB schema
+
+        Args:
+            base (sqlite3.Connection): Connection to the new DB
         """
-        base = sqlite3.connect("data/boomerang.sqlite3")
         cursor = base.cursor()
         cursor.execute('CREATE TABLE "people" ("id" INTEGER NOT NULL UNIQUE, "name" TEXT, "timezone" TEXT, PRIMARY KEY("id"))')
         cursor.execute('CREATE TABLE "reminders" ("id" INTEGER NOT NULL UNIQUE, "author" INTEGER NOT NULL, "date_creation" INTEGER NOT NULL, "date_next" INTEGER NOT NULL, "recurrence" TEXT, "recurrence_limit" INTEGER, "text" TEXT, "color" INTEGER, PRIMARY KEY("id" AUTOINCREMENT))')
-        cursor.execute('CREATE INDEX "i_people_id" ON "people" ("id" ASC)')
-        cursor.execute('CREATE INDEX "i_reminders_id" ON "reminders" ("id" ASC)')
         base.commit()
-        base.close()
+
+
+    def migrate(self, base):
+        """
+        Brings the DB schema up to date by applying the migrations it is missing.
+
+        Args:
+            base (sqlite3.Connection): Connection to the DB
+        """
+        version = base.execute("PRAGMA user_version").fetchone()[0]
+
+        for number, statements in enumerate(MIGRATIONS[version:], start=version+1):
+            with base:
+                for statement in statements:
+                    base.execute(statement)
+                base.execute(f"PRAGMA user_version={number}")
+
+
+    def check_query_plans(self):
+        """
+        Checks with EXPLAIN QUERY PLAN that the hot queries are using their index.
+
+        Returns:
+            list: Queries not using the expected index, with their plan. Empty if everything is right.
+        """
+        problems = []
+        for query, params, index in HOT_QUERIES:
+            self.cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+            plan = " / ".join(row["detail"] for row in self.cursor.fetchall())
+            if index not in plan:
+                problems.append((query, plan))
+        return problems
+
+
+    def _reminders_cursor(self, query, params=()):
+        """
+        Runs a query selecting reminders, with a cursor returning them as Reminder objects.
+
+        Args:
+            query (str): Query, selecting the columns of REMINDER_COLUMNS (and optionally the timezone), in order
+            params (tuple, optional): Parameters of the query
+
+        Returns:
+            sqlite3.Cursor: Cursor to fetch the reminders from
+        """
+        cursor = self.base.cursor()
+        cursor.row_factory = _reminder
+        return cursor.execute(query, params)
 
 
     def select_reminder(self, id):
@@ -37,39 +233,45 @@ class Database():
             id (int): Reminder ID
 
         Returns:
-            dict: Reminder
+            Reminder: Reminder
         """
-        self.cursor.execute("SELECT * FROM reminders WHERE id=?", (id,))
-        r = self.cursor.fetchone()
+        r = self._reminders_cursor(f"{SELECT_REMINDERS} WHERE reminders.id=?", (id,)).fetchone()
         if r is None:
             raise IndexError("Reminder does not exist in database")
         else:
             return r
 
 
-    def count_reminders(self):
+    def select_reminders_user(self, author, after=None, before=None, limit=10):
         """
-        Counts reminders.
-
-        Returns:
-            int: Reminder count
-        """
-        self.cursor.execute("SELECT COUNT(*) AS len FROM reminders")
-        return self.cursor.fetchone()["len"]
-
-
-    def select_reminders_user(self, author):
-        """
-        Returns all the reminders belonging to someone.
+        Returns a page of the reminders belonging to someone, by next occurrence.
+        Pages are found from the (date_next, id) key of a reminder of the adjacent page (keyset pagination),
+        so that only the rows of the page are read through the (author, date_next) index, however many reminders there are.
 
         Args:
             author (discord.User): User requesting the select
+            after (tuple, optional): Key of the last reminder of the previous page, to get the next page
+            before (tuple, optional): Key of the first reminder of the next page, to get the previous page
+            limit (int, optional): Size of the page
 
         Returns:
-            list: All reminders belonging to someone. Can be empty.
+            list: Reminders of the page, by next occurrence. Can be empty.
+            bool: If there are other reminders further in the direction of the navigation
         """
-        self.cursor.execute("SELECT * FROM reminders WHERE author=?", (author.id,))
-        return self.cursor.fetchall()
+        if after is not None:
+            cursor = self._reminders_cursor(f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE author=? AND (date_next, id) > (?, ?) ORDER BY date_next, id LIMIT ?", (author.id, *after, limit+1))
+        elif before is not None:
+            cursor = self._reminders_cursor(f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE author=? AND (date_next, id) < (?, ?) ORDER BY date_next DESC, id DESC LIMIT ?", (author.id, *before, limit+1))
+        else:
+            cursor = self._reminders_cursor(f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE author=? ORDER BY date_next, id LIMIT ?", (author.id, limit+1))
+
+        # one more row than needed is read, only to know if there is something after the page
+        reminders = cursor.fetchmany(limit+1)
+        more = len(reminders) > limit
+        reminders = reminders[:limit]
+        if before is not None:
+            reminders.reverse()
+        return reminders, more
 
 
     def select_user_timezone(self, author):
@@ -90,29 +292,60 @@ class Database():
             raise IndexError("User does not exist in database")
 
 
-    def select_reminders_now(self):
+    def select_reminders_schedule(self, start=None, end=None):
         """
-        Returns all the reminders that must be fired now.
+        Returns the ID, next occurrence and tolerance of every reminder, to build the scheduler timeline.
+
+        Args:
+            start (int, optional): Only the reminders due from this timestamp
+            end (int, optional): Only the reminders due before this timestamp (excluded)
 
         Returns:
-            list: List of reminders. Can be empty.
+            list: (id, date_next, tolerance) tuples. Can be empty.
+        """
+        cursor = self.base.cursor()
+        cursor.row_factory = None # plain tuples, there can be a lot of them
+        if start is None:
+            cursor.execute("SELECT id, date_next, tolerance FROM reminders")
+        else:
+            cursor.execute("SELECT id, date_next, tolerance FROM reminders WHERE date_next >= ? AND date_next < ?", (start, end))
+        return cursor.fetchall()
+
+
+    def select_reminders_ids(self, ids):
         """
-        now = datetime.datetime.now(datetime.timezone.utc).replace(second=59, microsecond=0)
-        self.cursor.execute("SELECT * FROM reminders WHERE date_next < ?", (int(datetime.datetime.timestamp(now)),))
+        Returns some reminders.
+
+        Args:
+            ids (list): Reminder IDs
 
+        Returns:
+            list: Reminders (with the timezone of their author) that still exist. Can be empty.
+        """
         reminders = []
-        for reminder in self.cursor.fetchall():
-            reminders.append({
-                "id": reminder["id"],
-                "author": reminder["author"],
-                "date_creation": reminder["date_creation"],
-                "text": reminder["text"],
-                "color": reminder["color"]
-            })
+        ids = list(ids)
+        for i in range(0, len(ids), 500): # staying under the limit of variables of a query
+            chunk = ids[i:i+500]
+            reminders.extend(self._reminders_cursor(f"{SELECT_REMINDERS} WHERE reminders.id IN ({','.join('?'*len(chunk))})", chunk).fetchall())
         return reminders
 
 
-    def insert_reminder(self, author, date_creation, date_next, text, color, recurrence=None, recurrence_limit=None):
+    def select_reminders_now(self, now=None):
+        """
+        Returns all the reminders that must be fired now.
+
+        Args:
+            now (datetime.datetime, optional): Datetime of reference. Defaults to current time.
+
+        Returns:
+            list: Reminders (with the timezone of their author). Can be empty.
+        """
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        return self._reminders_cursor(f"{SELECT_REMINDERS} WHERE date_next <= ?", (int(datetime.datetime.timestamp(now)),)).fetchall()
+
+
+    def insert_reminder(self, author, date_creation, date_next, text, color, recurrence=None, recurrence_limit=None, tolerance=None):
         """
         Insert a new reminder in database
 
@@ -122,14 +355,92 @@ class Database():
             date_next (datetime): When is the next occurrence of the reminder
             text (str): Text of the reminder
             color (Discord Color object): Color associated with the reminder
-            recurrence (str, optional): Expression ("4d", "3h"...) telling how often the reminder should be fired. If None, no recurrence.
+            recurrence (str, optional): Expression ("4d", "3h"..., or "cron 0 8 * * 1") telling how often the reminder should be fired. If None, no recurrence.
             recurrence_limit (int, optional): For recurrence-enabled events: how many times the reminder should be fired. If None, no limit. (Not implemented yet)
+            tolerance (int, optional): How many seconds the reminder may be sent earlier or later. If None, default of the config file.
+
+        Returns:
+            int: ID of the new reminder
         """
-        self.cursor.execute("INSERT INTO reminders (author, date_creation, date_next, recurrence, recurrence_limit, text, color) VALUES (?, ?, ?, ?, ?, ?, ?)", (author.id, datetime.datetime.timestamp(date_creation), datetime.datetime.timestamp(date_next), recurrence, recurrence_limit, text, color))
+        self.cursor.execute("INSERT INTO reminders (author, date_creation, date_next, recurrence, recurrence_limit, text, color, tolerance) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (author.id, datetime.datetime.timestamp(date_creation), datetime.datetime.timestamp(date_next), recurrence, recurrence_limit, text, color, tolerance))
         self.base.commit()
+        return self.cursor.lastrowid
+
+
+    def select_occurrences(self, ids):
+        """
+        Returns the materialized upcoming occurrences of some reminders.
+
+        Args:
+            ids (list): Reminder IDs
+
+        Returns:
+            dict: Reminder ID -> timestamps of the occurrences following date_next, in order. Reminders without any are missing.
+        """
+        occurrences = {}
+        ids = list(ids)
+        for i in range(0, len(ids), 500): # staying under the limit of variables of a query
+            chunk = ids[i:i+500]
+            self.cursor.execute(f"SELECT reminder, date FROM occurrences WHERE reminder IN ({','.join('?'*len(chunk))}) ORDER BY reminder, date", chunk)
+            for row in self.cursor:
+                occurrences.setdefault(row["reminder"], []).append(row["date"])
+        return occurrences
+
+
+    def select_reminders_horizon(self, after=0, limit=500):
+        """
+        Returns recurring reminders, with what is already materialized of their upcoming occurrences.
+        Reminders are returned by ID, a page at a time.
 
+        Args:
+            after (int, optional): ID of the last reminder of the previous page
+            limit (int, optional): Size of the page
 
-    def update_reminder_recurrence(self, id, date_next, recurrence_limit):
+        Returns:
+            list: Reminders, with their author timezone, the last materialized occurrence ("last", None if there is none) and how many there are ("materialized")
+        """
+        self.cursor.execute("SELECT reminders.id, reminders.date_next, reminders.recurrence, reminders.recurrence_limit, people.timezone, MAX(occurrences.date) AS last, COUNT(occurrences.date) AS materialized FROM reminders LEFT JOIN people ON people.id = reminders.author LEFT JOIN occurrences ON occurrences.reminder = reminders.id WHERE reminders.id > ? AND reminders.recurrence IS NOT NULL GROUP BY reminders.id ORDER BY reminders.id LIMIT ?", (after, limit))
+        return self.cursor.fetchall()
+
+
+    def insert_occurrences(self, occurrences):
+        """
+        Adds materialized occurrences, all in one transaction.
+        Occurrences are computed from a previous read: the ones of reminders deleted or rescheduled since are skipped.
+
+        Args:
+            occurrences (list): (reminder ID, timestamp) tuples
+        """
+        with self.base:
+            self.cursor.executemany("INSERT OR IGNORE INTO occurrences SELECT ?, ? WHERE EXISTS (SELECT 1 FROM reminders WHERE id=? AND date_next < ?)", ((id, date, id, date) for id, date in occurrences))
+
+
+    def clear_occurrences(self):
+        """
+        Deletes all the materialized occurrences (they may be outdated if materialization was disabled for a while).
+        """
+        with self.base:
+            self.cursor.execute("DELETE FROM occurrences")
+
+
+    def count_upcoming(self, start, end):
+        """
+        Counts the reminders to fire per hour in a time range: reminders due in date_next,
+        and materialized occurrences of the recurring ones.
+        Only accurate within the materialized horizon.
+
+        Args:
+            start (int): Timestamp of the beginning of the range
+            end (int): Timestamp of the end of the range (excluded)
+
+        Returns:
+            list: (timestamp of the hour, number of reminders) tuples, in order. Hours without reminders are missing.
+        """
+        self.cursor.execute("SELECT hour, COUNT(*) FROM (SELECT date_next / 3600 * 3600 AS hour FROM reminders WHERE date_next >= ? AND date_next < ? UNION ALL SELECT date / 3600 * 3600 FROM occurrences WHERE date >= ? AND date < ?) GROUP BY hour ORDER BY hour", (start, end, start, end))
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+
+    def update_reminder_recurrence(self, id, date_next, recurrence_limit, occurrences=False):
         """
         Updates a reminder to set its next occurrence.
 
@@ -137,12 +448,15 @@ class Database():
             id (int): Reminder ID
             date_next (datetime.datetime): Datetime object of the next reminder datetime 
             recurrence_limit (int): How many times should the reminder be fired again. (Not implemented yet)
+            occurrences (bool, optional): If occurrences are materialized, and must be updated too. Defaults to False.
         """
         self.cursor.execute("UPDATE reminders SET date_next=?, recurrence_limit=? WHERE id=?", (int(date_next.timestamp()), recurrence_limit, id))
+        if occurrences:
+            self.cursor.execute("DELETE FROM occurrences WHERE reminder=? AND date <= ?", (id, int(date_next.timestamp())))
         self.base.commit()
 
 
-    def update_user_timezone(self, author, tz):
+    def update_user_timezone(self, author, tz, occurrences=False):
         """
         Updates the timezone of someone in the database.
         If user does not exist, creates it as well
@@ -150,6 +464,7 @@ class Database():
         Args:
             author (Discord User/Member object): Requestor
             tz (pytz timezone): pytz timezone
+            occurrences (bool, optional): If occurrences are materialized, and must be updated too. Defaults to False.
         """
         self.cursor.execute("SELECT * FROM people WHERE id=?", (author.id,))
 
@@ -157,16 +472,242 @@ class Database():
             self.cursor.execute("UPDATE people SET name=?, timezone=? WHERE id=?", ((author.name+'#'+str(author.discriminator)), str(tz), author.id))
         else:
             self.cursor.execute("INSERT INTO people VALUES (?, ?, ?)", (author.id, author.name+'#'+str(author.discriminator), str(tz)))
-        
+
+        # cron occurrences depend on the timezone: they will be computed again
+        if occurrences:
+            self.cursor.execute("DELETE FROM occurrences WHERE reminder IN (SELECT id FROM reminders WHERE author=?)", (author.id,))
         self.base.commit()
 
 
-    def delete_reminder(self, id):
+    def delete_reminder(self, id, occurrences=False):
         """
         Delete a reminder from the database.
 
         Args:
             id (int): Reminder ID
+            occurrences (bool, optional): If occurrences are materialized, and must be deleted too. Defaults to False.
         """
         self.cursor.execute("DELETE FROM reminders WHERE id=?", (id,))
+        if occurrences:
+            self.cursor.execute("DELETE FROM occurrences WHERE reminder=?", (id,))
         self.base.commit()
+
+
+    def apply_reminders_fate(self, deleted, updated, occurrences=False):
+        """
+        Deletes and updates fired reminders, all in one transaction.
+
+        Args:
+            deleted (list): IDs of the reminders to delete
+            updated (list): (id, date_next, recurrence_limit) tuples of the reminders to reschedule
+            occurrences (bool, optional): If occurrences are materialized, and must be updated too. Defaults to False.
+        """
+        with self.base:
+            self.cursor.executemany("DELETE FROM reminders WHERE id=?", ((id,) for id in deleted))
+            # only moving forward: a later firing of the same reminder may have been saved first
+            self.cursor.executemany("UPDATE reminders SET date_next=?, recurrence_limit=?, lease_owner=NULL, lease_until=NULL WHERE id=? AND date_next < ?", ((int(date_next.timestamp()), recurrence_limit, id, int(date_next.timestamp())) for id, date_next, recurrence_limit in updated))
+            # occurrences that are now passed (or scheduled in date_next)
+            if occurrences:
+                self.cursor.executemany("DELETE FROM occurrences WHERE reminder=?", ((id,) for id in deleted))
+                self.cursor.executemany("DELETE FROM occurrences WHERE reminder=? AND date <= ?", ((id, int(date_next.timestamp())) for id, date_next, _ in updated))
+
+
+    def claim_reminders_now(self, owner, lease, shard=0, shards=1, limit=500, now=None):
+        """
+        Claims the reminders that must be fired now, for a worker process.
+        Claimed reminders are leased to the worker: other workers do not get them until
+        the lease expires, so if the worker dies before firing them, they are fired by another one.
+        The fate of the reminders (apply_reminders_fate) releases the lease.
+
+        Args:
+            owner (str): Name of the worker
+            lease (int): How many seconds the reminders are leased for
+            shard (int, optional): Index of the worker. Defaults to 0.
+            shards (int, optional): Number of workers; each one gets the reminders of a share of the authors. Defaults to 1.
+            limit (int, optional): Maximum number of reminders claimed at once. Defaults to 500.
+            now (datetime.datetime, optional): Datetime of reference. Defaults to current time.
+
+        Returns:
+            list: Claimed reminders (same format as select_reminders_now). Can be empty.
+        """
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        now = int(now.timestamp())
+        lease_until = now + lease
+
+        # one statement: rows are selected and leased while holding the write lock
+        with self.base:
+            self.cursor.execute("UPDATE reminders SET lease_owner=?, lease_until=? WHERE id IN (SELECT id FROM reminders WHERE date_next <= ? AND (lease_until IS NULL OR lease_until < ?) AND author % ? = ? LIMIT ?)", (owner, lease_until, now, now, shards, shard, limit))
+        return self._reminders_cursor(f"{SELECT_REMINDERS} WHERE date_next <= ? AND lease_owner=? AND lease_until=?", (now, owner, lease_until)).fetchall()
+
+
+    def insert_deliveries(self, deliveries):
+        """
+        Appends outcomes of deliveries to the history, all in one transaction.
+
+        Args:
+            deliveries (list): (reminder, author, date_due, date_sent, outcome) tuples
+        """
+        with self.base:
+            self.cursor.executemany("INSERT INTO deliveries VALUES (?, ?, ?, ?, ?)", deliveries)
+
+
+    def select_deliveries(self, author=None, limit=20):
+        """
+        Returns the latest deliveries of the history.
+
+        Args:
+            author (int, optional): Snowflake of the user to get the deliveries of. Defaults to everyone.
+            limit (int, optional): Maximum number of deliveries
+
+        Returns:
+            list: (reminder, author, date_due, date_sent, outcome) tuples, latest first
+        """
+        if author is not None:
+            self.cursor.execute("SELECT * FROM deliveries WHERE author=? ORDER BY date_sent DESC LIMIT ?", (author, limit))
+        else:
+            self.cursor.execute("SELECT * FROM deliveries ORDER BY date_sent DESC LIMIT ?", (limit,))
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+
+    def prune_deliveries(self, before, limit=5000):
+        """
+        Deletes the oldest deliveries of the history.
+        Rows are deleted by chunks, to keep the write lock for a short time only.
+
+        Args:
+            before (int): Timestamp before which deliveries are deleted
+            limit (int, optional): Maximum number of rows deleted
+
+        Returns:
+            int: Number of rows deleted; if it is limit, there may be more to delete
+        """
+        with self.base:
+            self.cursor.execute("DELETE FROM deliveries WHERE rowid IN (SELECT rowid FROM deliveries WHERE date_sent < ? ORDER BY date_sent LIMIT ?)", (before, limit))
+        return self.cursor.rowcount
+
+
+    def vacuum(self, pages=1000):
+        """
+        Gives free pages of the file (left by deletions) back to the file system.
+        Unlike VACUUM, which rebuilds the whole file, only a few pages are moved at once,
+        so that the other queries do not wait for long.
+
+        Args:
+            pages (int, optional): Maximum number of pages given back
+
+        Returns:
+            int: Number of pages given back; if it is pages, there may be more to give back
+        """
+        free = self.base.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            # executescript: each step of the statement gives back one page, and execute would only do one
+            self.base.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return min(free, pages)
+
+
+    def analyze(self):
+        """
+        Refreshes the statistics of the query planner (sampled, see connect).
+        """
+        self.base.execute("ANALYZE")
+
+
+    def export_table(self, table, size=1000):
+        """
+        Reads all the rows of a table, without loading them all in memory.
+
+        Args:
+            table (str): "people" or "reminders"
+            size (int, optional): How many rows are fetched at once
+
+        Yields:
+            tuple: Row, with the values of COLUMNS[table]
+        """
+        cursor = self.base.cursor() # own cursor: other methods can be used while reading
+        cursor.execute(f"SELECT {', '.join(COLUMNS[table])} FROM {table} ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+
+
+    def import_table(self, table, rows, chunk=10000, new_ids=False):
+        """
+        Writes rows in a table, by chunks, all in one transaction: if something fails, nothing is imported.
+        People already existing are replaced; reminders are added.
+
+        Args:
+            table (str): "people" or "reminders"
+            rows (iterable): Rows, with the values of COLUMNS[table]
+            chunk (int, optional): How many rows are given to executemany at once
+            new_ids (bool, optional): Whether reminders get new IDs instead of keeping theirs
+
+        Returns:
+            int: Number of rows imported
+        """
+        columns = COLUMNS[table]
+        if new_ids:
+            columns = columns[1:]
+        verb = "INSERT OR REPLACE" if table == "people" else "INSERT"
+        query = f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))})"
+
+        count = 0
+        with self.base:
+            batch = []
+            for row in rows:
+                batch.append(row[1:] if new_ids else row)
+                if len(batch) >= chunk:
+                    self.cursor.executemany(query, batch)
+                    count += len(batch)
+                    batch = []
+            self.cursor.executemany(query, batch)
+            count += len(batch)
+        self.base.execute("ANALYZE")
+        return count
+
+
+class AsyncDatabase():
+    """
+    Awaitable version of Database, to be used from the event loop.
+    Every Database method is available as a coroutine, run in a dedicated thread,
+    so that disk I/O never blocks the event loop. Calls are run one at a time, in order.
+
+    Usage:
+    ```
+    db = models.AsyncDatabase()
+    reminders, more = await db.select_reminders_user(author)
+    ```
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+    def __init__(self):
+        self.db = Database()
+
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+
+        def run(args, kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.database_seconds.observe(time.perf_counter() - start, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run, args, kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+
+    @classmethod
+    def shutdown(cls):
+        """
+        Waits for the pending calls, and stops the database thread.
+        """
+        cls.executor.shutdown(wait=True)
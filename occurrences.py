@@ -0,0 +1,193 @@
+"""
+Materialized occurrences of the recurring reminders, when enabled in the config file.
+The next occurrences of each recurring reminder (following date_next) are computed in advance
+and stored in the "occurrences" table, by a background job extending the horizon regularly.
+They are read by the fire loop instead of computing the next occurrences, and they make
+forecasting the load of the coming hours a simple range count.
+
+Forecast from the command line, per hour (or per minute, with the tolerance windows of the config file):
+```
+python occurrences.py [--hours 24]
+python occurrences.py --minutes 60
+```
+"""
+
+# Project libs
+from configs import config, log
+import metrics, models, scheduler, utils
+
+# Standard libs
+import argparse, asyncio, datetime, time
+
+
+# Forecasts exposed in the metrics, in hours
+FORECASTS = (1, 6, 24)
+
+
+def settings():
+    return config.get('occurrences') or {}
+
+
+def enabled():
+    return settings().get('enabled', False)
+
+
+async def horizon(db, reminders):
+    """
+    Returns the materialized occurrences of fired reminders, to be given to utils.reminders_fate.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        reminders (list): Fired reminders
+
+    Returns:
+        dict: Reminder ID -> timestamps of the occurrences following date_next, or None if disabled
+    """
+    if not enabled():
+        return None
+    return await db.select_occurrences([reminder.id for reminder in reminders if reminder.recurrence is not None])
+
+
+def upcoming(reminder, until, count):
+    """
+    Computes the occurrences missing from the horizon of a recurring reminder.
+
+    Args:
+        reminder (dict): Reminder, as returned by Database.select_reminders_horizon
+        until (int): Timestamp of the end of the horizon
+        count (int): Maximum number of occurrences materialized per reminder
+
+    Returns:
+        list: (reminder ID, timestamp) tuples to add
+    """
+    wanted = count - reminder["materialized"]
+    if reminder["recurrence_limit"] is not None: # date_next is one of the remaining occurrences
+        wanted = min(wanted, reminder["recurrence_limit"] - 1 - reminder["materialized"])
+
+    start = reminder["last"] if reminder["last"] is not None else reminder["date_next"]
+    date = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    occurrences = []
+    while len(occurrences) < wanted:
+        date = utils.reminder_next(date, reminder["recurrence"], reminder["timezone"])
+        timestamp = int(date.timestamp())
+        if timestamp >= until:
+            break
+        occurrences.append((reminder["id"], timestamp))
+    return occurrences
+
+
+async def extend(db, now=None, hours=None):
+    """
+    Extends the horizon of all the recurring reminders.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        now (float, optional): Timestamp of reference. Defaults to current time.
+        hours (int, optional): How many hours ahead. Defaults to the "hours" setting.
+
+    Returns:
+        int: Number of occurrences added
+    """
+    if now is None:
+        now = time.time()
+    if hours is None:
+        hours = settings().get('hours', 48)
+    until = int(now + hours*3600)
+    count = settings().get('count', 50)
+
+    added = 0
+    after = 0
+    while True:
+        reminders = await db.select_reminders_horizon(after)
+        if not reminders:
+            return added
+
+        occurrences = []
+        for reminder in reminders:
+            try:
+                occurrences.extend(upcoming(reminder, until, count))
+            except ValueError: # recurrence that cannot be computed anymore; it is computed when firing
+                log.warning("Reminder %s: occurrences of recurrence %s cannot be computed", reminder["id"], reminder["recurrence"])
+        if occurrences:
+            await db.insert_occurrences(occurrences)
+        added += len(occurrences)
+        after = reminders[-1]["id"]
+        await asyncio.sleep(0) # letting the commands run between pages
+
+
+async def forecast(db, hours, now=None):
+    """
+    Counts the reminders to fire in the coming hours.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+        hours (int): How many hours ahead
+        now (float, optional): Timestamp of reference. Defaults to current time.
+
+    Returns:
+        list: (timestamp of the hour, number of reminders) tuples
+    """
+    if now is None:
+        now = time.time()
+    return await db.count_upcoming(int(now), int(now + hours*3600))
+
+
+async def keep(db):
+    """
+    Background job extending the horizon every "interval" seconds, and updating the forecast metrics.
+
+    Args:
+        db (models.AsyncDatabase): Database instance
+    """
+    interval = settings().get('interval', 600)
+    cleared = False
+    while True:
+        # an error must not stop the job: the horizon would not be extended anymore
+        try:
+            if not cleared:
+                await db.clear_occurrences() # not updated while materialization was disabled
+                cleared = True
+            start = time.perf_counter()
+            added = await extend(db)
+            log.debug("Horizon extended with %s occurrences in %.3fs", added, time.perf_counter() - start)
+
+            for hours in FORECASTS:
+                if hours <= settings().get('hours', 48):
+                    metrics.upcoming_reminders.set(sum(count for _, count in await forecast(db, hours)), f'{hours}h')
+        except Exception as e:
+            log.error(f'Uncaught exception in the occurrences job: {e}', exc_info=True)
+        await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forecast of the reminders to fire in the coming hours")
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--minutes', type=int, help="per-minute load of the coming minutes instead: reminders due, and sent within their tolerance window (next occurrences only)")
+    args = parser.parse_args()
+
+    async def main():
+        db = models.AsyncDatabase()
+        if args.minutes:
+            tolerance = (config.get('delivery') or {}).get('tolerance', 0)
+            start = int(time.time()) // 60 * 60
+            margin = max(tolerance, scheduler.MAX_TOLERANCE)
+            reminders = await db.select_reminders_schedule(start - margin, start + args.minutes*60 + margin)
+
+            due, sent = scheduler.Scheduler(), scheduler.Scheduler()
+            due.load((id, date_next, 0) for id, date_next, _ in reminders)
+            sent.tolerance = tolerance
+            sent.load(reminders)
+            print('minute            due  sent')
+            for minute, (count_due, count_sent) in enumerate(zip(due.histogram(start, args.minutes), sent.histogram(start, args.minutes))):
+                print(f'{datetime.datetime.fromtimestamp(start + minute*60):%Y-%m-%d %H:%M}  {count_due:>4}  {count_sent:>4}')
+            return
+
+        await extend(db, hours=max(args.hours, settings().get('hours', 48)))
+        for hour, count in await forecast(db, args.hours):
+            print(f'{datetime.datetime.fromtimestamp(hour):%Y-%m-%d %H:00}  {count}')
+
+    try:
+        asyncio.run(main())
+    finally:
+        models.AsyncDatabase.shutdown()
+        models.Database.close()
@@ -0,0 +1,185 @@
+# Standard libs
+import asyncio, heapq, time
+
+
+# Entries of the heap are single integers, fire time << ID_BITS | id: they take less memory
+# than (fire time, id) tuples, and are ordered the same way
+ID_BITS = 40
+ID_MASK = (1 << ID_BITS) - 1
+
+# Longest tolerance window that can be given to a reminder ("~1h"), in seconds
+MAX_TOLERANCE = 3600
+
+
+class Scheduler():
+    """
+    In-memory timeline of the pending reminders, used by the fire loop to sleep exactly
+    until the next reminder is due instead of polling the database.
+
+    Entries are kept in a min-heap keyed on the time they must be fired: date_next, or a time
+    within their tolerance window if they have one (see fire_time). Removed or rescheduled
+    reminders are not searched for in the heap: their old entries are simply skipped when
+    they reach the top (lazy deletion).
+    """
+    def __init__(self):
+        self.heap = [] # fire time << ID_BITS | id
+        self.pending = {} # id -> fire time, reference for what is really scheduled
+        self.wakeup = asyncio.Event()
+        self.enabled = True # when disabled (reminders fired by other processes), changes are ignored
+        self.tolerance = 0 # tolerance window (in seconds) of the reminders without their own
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def load(self, reminders):
+        """
+        Fills the timeline with every reminder stored in database.
+
+        Args:
+            reminders (list): (id, date_next, tolerance) tuples, as returned by Database.select_reminders_schedule
+        """
+        self.pending = {id: self.fire_time(id, int(date_next), tolerance) for id, date_next, tolerance in reminders}
+        self.heap = [fire << ID_BITS | id for id, fire in self.pending.items()]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+
+    def push(self, id, date_next, tolerance=None):
+        """
+        Adds a reminder to the timeline, or reschedules it if it is already there.
+        Wakes up the fire loop if this reminder is now the first one to come.
+
+        Args:
+            id (int): Reminder ID
+            date_next (datetime.datetime or int): When the reminder is due
+            tolerance (int, optional): Tolerance window of the reminder, in seconds. Defaults to the one of the timeline.
+        """
+        if not self.enabled:
+            return
+        if not isinstance(date_next, (int, float)):
+            date_next = date_next.timestamp()
+        fire = self.fire_time(id, int(date_next), tolerance)
+
+        entry = fire << ID_BITS | id
+        self.pending[id] = fire
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] == entry:
+            self.wakeup.set()
+
+
+    def discard(self, id):
+        """
+        Removes a reminder from the timeline. Does nothing if it is not scheduled.
+
+        Args:
+            id (int): Reminder ID
+        """
+        if not self.enabled:
+            return
+        self.pending.pop(id, None)
+
+
+    def fire_time(self, id, date_next, tolerance=None):
+        """
+        Returns when a reminder should be fired: date_next, moved within its tolerance window
+        [date_next - tolerance, date_next + tolerance]. The offset is derived from the ID and the date,
+        so that reminders due at the same time are spread evenly over the window.
+        Reminders without tolerance are fired exactly when they are due.
+
+        Args:
+            id (int): Reminder ID
+            date_next (int): Timestamp the reminder is due at
+            tolerance (int, optional): Tolerance window of the reminder, in seconds. Defaults to the one of the timeline.
+
+        Returns:
+            int: Timestamp
+        """
+        if tolerance is None:
+            tolerance = self.tolerance
+        if not tolerance:
+            return date_next
+        return date_next + (id * 2654435761 + date_next) % (2*tolerance + 1) - tolerance
+
+
+    def histogram(self, start, minutes=60):
+        """
+        Counts the reminders to fire in each of the coming minutes.
+
+        Args:
+            start (int): Timestamp of the beginning of the first minute
+            minutes (int, optional): How many minutes
+
+        Returns:
+            list: Number of reminders to fire, per minute
+        """
+        counts = [0] * minutes
+        end = start + minutes*60
+        for fire in self.pending.values():
+            if start <= fire < end:
+                counts[(fire - start) // 60] += 1
+        return counts
+
+
+    def next_time(self):
+        """
+        Returns the timestamp of the first reminder to come.
+
+        Returns:
+            int: Timestamp, or None if nothing is scheduled
+        """
+        while self.heap:
+            fire, id = self.heap[0] >> ID_BITS, self.heap[0] & ID_MASK
+            if self.pending.get(id) == fire:
+                return fire
+            heapq.heappop(self.heap) # stale entry
+        return None
+
+
+    def pop_due(self, now=None):
+        """
+        Removes from the timeline every reminder that is due.
+
+        Args:
+            now (int, optional): Timestamp of reference. Defaults to current time.
+
+        Returns:
+            list: IDs of the due reminders
+        """
+        if now is None:
+            now = time.time()
+
+        due = []
+        while True:
+            fire = self.next_time()
+            if fire is None or fire > now:
+                return due
+            id = heapq.heappop(self.heap) & ID_MASK
+            del self.pending[id]
+            due.append(id)
+
+
+    async def wait(self):
+        """
+        Sleeps until the first reminder is due, or until the timeline changes
+        in a way that the first reminder to come is now an earlier one.
+
+        Returns:
+            bool: True if a reminder is due, False if the wait was interrupted
+        """
+        self.wakeup.clear()
+        date_next = self.next_time()
+        timeout = None if date_next is None else date_next - time.time()
+        if timeout is not None and timeout <= 0:
+            return True
+
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+
+# Timeline shared by the fire loop and the commands
+timeline = Scheduler()
@@ -0,0 +1,207 @@
+"""
+Export and import of the people and reminders, to move users between instances or to restore a backup.
+Rows are streamed: exports are read from the database and imports are written to it by chunks,
+so that the memory used does not depend on the number of rows.
+
+Files are in JSON Lines (one object per row) or CSV (with a header), depending on
+their extension or on --format. "-" is the standard input/output.
+Imports are meant to be done while the bot is stopped (reminders are scheduled when it starts).
+
+Usage:
+```
+python3 transfer.py export people people.jsonl
+python3 transfer.py export reminders reminders.csv
+python3 transfer.py import people people.jsonl
+python3 transfer.py import reminders reminders.csv [--new-ids] [--chunk 10000]
+```
+"""
+
+# Project libs
+import cron, models, utils
+
+# 3rd-party libs
+import pytz
+
+# Standard libs
+import argparse, csv, datetime, functools, json, sqlite3, sys, time
+
+
+# Columns that must have a value (reminders without ID get a new one)
+REQUIRED = {
+    "people": ("id",),
+    "reminders": ("author", "date_creation", "date_next"),
+}
+
+# Columns holding numbers
+INTEGERS = ("id", "author", "date_creation", "date_next", "recurrence_limit", "color", "tolerance")
+
+
+def export(table, file, format):
+    """
+    Writes all the rows of a table in a file.
+
+    Args:
+        table (str): "people" or "reminders"
+        file (file): Text file to write to
+        format (str): "jsonl" or "csv"
+
+    Returns:
+        int: Number of rows exported
+    """
+    columns = models.COLUMNS[table]
+    count = 0
+
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for row in models.Database().export_table(table):
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in models.Database().export_table(table):
+            file.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+            count += 1
+
+    return count
+
+
+def records(file, format):
+    """
+    Reads the rows of a file.
+
+    Args:
+        file (file): Text file to read from
+        format (str): "jsonl" or "csv"
+
+    Yields:
+        int: Line number
+        dict or str: Column name -> value (CSV), or JSON object to decode (JSON Lines)
+    """
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(file, start=1):
+            if line.strip():
+                yield number, line
+
+
+def row(table, record):
+    """
+    Converts a record read from a file into a row of a table, checking its values.
+
+    Args:
+        table (str): "people" or "reminders"
+        record (dict or str): Column name -> value, or JSON object
+
+    Returns:
+        tuple: Row, with the values of models.COLUMNS[table]
+    """
+    if isinstance(record, str):
+        record = json.loads(record)
+
+    values = []
+    for column in models.COLUMNS[table]:
+        value = record.get(column)
+        if value == '' and column != "text": # CSV has no NULL
+            value = None
+        if value is None:
+            if column in REQUIRED[table]:
+                raise ValueError(f'missing {column}')
+        elif column in INTEGERS:
+            value = int(value)
+        else:
+            value = str(value)
+        values.append(value)
+
+    values = dict(zip(models.COLUMNS[table], values))
+    if table == "people" and values["timezone"] is not None:
+        try:
+            pytz.timezone(values["timezone"])
+        except pytz.exceptions.UnknownTimeZoneError:
+            raise ValueError(f'unknown timezone {values["timezone"]}')
+    if table == "reminders" and values["recurrence"] is not None:
+        check_recurrence(values["recurrence"])
+    return tuple(values.values())
+
+
+@functools.lru_cache(maxsize=4096) # recurrences are often the same
+def check_recurrence(recurrence):
+    """
+    Checks that a recurrence can be computed, and that it moves reminders forward.
+
+    Args:
+        recurrence (str): Recurrence information ("4d 3h", or "cron 0 8 * * 1")
+
+    Raises:
+        ValueError: If the recurrence is not valid
+    """
+    if recurrence.startswith('cron '):
+        cron.next_fire(recurrence[5:], datetime.datetime.now(datetime.timezone.utc))
+        return
+
+    start = datetime.datetime(2000, 1, 1)
+    if utils.timepoint_calculation(start, recurrence) <= start:
+        raise ValueError(f'recurrence {recurrence} is empty')
+
+
+def rows(table, file, format, rejected):
+    """
+    Reads the valid rows of a file. Invalid rows are skipped and counted.
+
+    Args:
+        table (str): "people" or "reminders"
+        file (file): Text file to read from
+        format (str): "jsonl" or "csv"
+        rejected (list): Line numbers of the rows skipped, filled while reading
+
+    Yields:
+        tuple: Row, with the values of models.COLUMNS[table]
+    """
+    for number, record in records(file, format):
+        try:
+            yield row(table, record)
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f'Line {number} skipped: {e}', file=sys.stderr)
+            rejected.append(number)
+
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export and import of the people and reminders")
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('table', choices=tuple(models.COLUMNS))
+    parser.add_argument('file', help='path of the file, or "-" for the standard input/output')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help="defaults to csv for .csv files, jsonl otherwise")
+    parser.add_argument('--chunk', type=int, default=10000, help="rows written at once when importing")
+    parser.add_argument('--new-ids', action='store_true', help="give new IDs to the imported reminders (to merge with existing ones)")
+    args = parser.parse_args()
+    format = args.format or ('csv' if args.file.endswith('.csv') else 'jsonl')
+
+    start = time.perf_counter()
+    status = 0
+    try:
+        if args.action == 'export':
+            with open_file(args.file, 'w') as file:
+                count = export(args.table, file, format)
+        else:
+            rejected = []
+            with open_file(args.file, 'r') as file:
+                count = models.Database().import_table(args.table, rows(args.table, file, format, rejected), args.chunk, args.new_ids and args.table == 'reminders')
+            if rejected:
+                print(f'{len(rejected)} rows skipped', file=sys.stderr)
+                status = 1
+        print(f'{count} rows {args.action}ed in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+    except sqlite3.IntegrityError as e:
+        print(f'Import cancelled, nothing was written: {e} (use --new-ids to merge reminders with existing ones)', file=sys.stderr)
+        status = 1
+    finally:
+        models.Database.close()
+
+    sys.exit(status)
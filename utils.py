@@ -1,12 +1,39 @@
 # Project libs
-from configs import log
+from configs import config, log
+import cron
+from scheduler import timeline
 
 # 3rd-party libs
 from dateutil.relativedelta import relativedelta
-import jinja2
+import jinja2, jinja2.meta
 
 # Standard libs
-import datetime, os
+import bisect, datetime
+
+
+# Reply templates. They are compiled once (and their bytecode is cached between runs);
+# with auto_reload, changes in ./templates are picked up without restarting (for development)
+_auto_reload = (config.get('templates') or {}).get('auto_reload', False)
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates", encoding="utf-8"),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(),
+    trim_blocks=True,
+    auto_reload=_auto_reload
+)
+static_templates = {} # template name -> text, for templates that do not use any variable
+
+
+def load_templates():
+    """
+    Compiles all the reply templates, and renders in advance the ones that do not use any variable.
+    """
+    static_templates.clear()
+
+    for filename in templates.list_templates(extensions=['md']):
+        template = templates.get_template(filename)
+        source = templates.loader.get_source(templates, filename)[0]
+        if not _auto_reload and not jinja2.meta.find_undeclared_variables(templates.parse(source)):
+            static_templates[filename[:-3]] = template.render()
 
 
 async def notify(template_name, user, vars=None):
@@ -18,72 +45,212 @@ async def notify(template_name, user, vars=None):
         user ([discord.User/Member]): User or Member object of Discord
         vars ([dict], optional): List of variables to replace in the template with format(). Defaults to None.
     """
-    if vars is None:
-        vars = {}
+    text = static_templates.get(template_name)
 
-    with open(os.path.join("templates", f'{template_name}.md'), 'r') as f:
-        text = f.read()
-
-    if vars is not None:
-        template = jinja2.Template(text, trim_blocks=True)
-        text = template.render(**vars)
+    if text is None:
+        if vars is None:
+            vars = {}
+        text = templates.get_template(f'{template_name}.md').render(**vars)
 
     await user.send(text)
 
 
-def reminder_fate(db, reminder_id):
+# When catching up, how many missed occurrences are counted one by one at most
+MAX_CATCH_UP = 10000
+
+
+async def reminders_fate(db, reminders, horizon=None):
     """
-    Decides the "fate" of a reminder (should it be deleted? should its next firing date be updated?)
+    Decides the "fate" of several fired reminders at once (should they be deleted? should their next firing date be updated?)
+    The scheduler timeline is updated accordingly.
+    Next occurrences are computed from the reminders given (see fates), then all the
+    changes are written in one transaction.
+
+    Args:
+        db (models.AsyncDatabase): Database instance (this function makes queries on DB)
+        reminders (list): Reminders, as returned by the DB (with recurrence, recurrence_limit and timezone)
+        horizon (dict, optional): Materialized occurrences of the reminders (see fates), None if they are not materialized
+
+    Returns:
+        dict: Reminder ID -> datetime of the next fire time of the reminder (None if reminder deleted)
+        dict: Reminder ID -> how many occurrences this firing covers (1 if none was missed)
+    """
+    nexts, occurrences, deleted, updated = fates(reminders, horizon=horizon)
+    await db.apply_reminders_fate(deleted, updated, horizon is not None)
+    reschedule(reminders, deleted, updated)
+    return nexts, occurrences
+
+
+def reschedule(reminders, deleted, updated):
+    """
+    Updates the scheduler timeline with the fate of fired reminders (see fates).
+
+    Args:
+        reminders (list): Fired reminders
+        deleted (list): IDs of the reminders deleted
+        updated (list): (id, date_next, recurrence_limit) tuples of the reminders rescheduled
+    """
+    tolerances = {reminder.id: reminder.tolerance for reminder in reminders}
+    for reminder_id in deleted:
+        timeline.discard(reminder_id)
+    for reminder_id, next, _ in updated:
+        timeline.push(reminder_id, next, tolerances[reminder_id])
+
+
+def fates(reminders, now=None, horizon=None):
+    """
+    Computes the fate of fired reminders, without applying it.
+
+    Recurring reminders keep their phase: the next occurrence is the first one after now
+    following date_next. If several occurrences passed (the bot was down), they are
+    counted and all covered by the current firing.
+    When the occurrences following date_next are materialized (see occurrences.py), they are
+    read from the horizon instead of being computed.
 
     Args:
-        db (models.Database): Database instance (this function makes queries on DB)
-        reminder_id (id): Reminder ID
+        reminders (list): Reminders, as returned by the DB (with recurrence, recurrence_limit and timezone)
+        now (datetime.datetime, optional): Datetime of reference. Defaults to current time.
+        horizon (dict, optional): Reminder ID -> timestamps of the occurrences following date_next, as returned by Database.select_occurrences
 
     Returns:
-        datetime.datetime: Datetime of the next fire time of the reminder. None if there is none (reminder deleted)
+        dict: Reminder ID -> datetime of the next fire time of the reminder (None if reminder deleted)
+        dict: Reminder ID -> how many occurrences this firing covers (1 if none was missed)
+        list: IDs of the reminders to delete
+        list: (id, date_next, recurrence_limit) tuples of the reminders to reschedule
     """
-    reminder = db.select_reminder(reminder_id)
-    now = datetime.datetime.now(datetime.timezone.utc)
-    next = None
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    nexts = {}
+    occurrences = {}
+    deleted = []
+    updated = []
 
-    if reminder["recurrence"] is None:
-        db.delete_reminder(reminder_id)
-        log.info(f"Reminder {reminder_id} was oneshot. Deleting it")
+    for reminder in reminders:
+        reminder_id = reminder.id
+        next = None
+        count = 1
 
-    elif reminder["recurrence_limit"] is not None:
-        if reminder["recurrence_limit"] <= 1:
-            db.delete_reminder(reminder_id)
-            log.info(f"Reminder {reminder_id} (recurring) has no more occurrences. Deleting it")
+        if reminder.recurrence is None:
+            deleted.append(reminder_id)
+            log.info("Reminder %s was oneshot. Deleting it", reminder_id)
         else:
-            recurrence_limit = reminder["recurrence_limit"]-1
             # Getting next reminder occurrence
-            next = reminder_next(now, reminder["recurrence"])
-            db.update_reminder_recurrence(reminder_id, next, recurrence_limit)
-            log.info(f"Reminder {reminder_id} (recurring) has {recurrence_limit} more occurrences. Next occurrence: {next.strftime('%Y-%m-%d %H:%M %Z')}")
-    else:
-        # Getting next reminder occurrence
-        next = reminder_next(now, reminder["recurrence"])
-        db.update_reminder_recurrence(reminder_id, next, None)
-        log.info(f"Reminder {reminder_id} (recurring) has no limit on occurrences. Next occurrence: {next.strftime('%Y-%m-%d %H:%M %Z')}")
-    
-    return next
+            upcoming = horizon.get(reminder_id) if horizon else None
+            if upcoming: # occurrences materialized before the reminder was rescheduled are outdated
+                upcoming = upcoming[bisect.bisect_right(upcoming, reminder.date_next):]
+            if upcoming and upcoming[-1] > now.timestamp():
+                missed = bisect.bisect_right(upcoming, now.timestamp())
+                next, count = datetime.datetime.fromtimestamp(upcoming[missed], datetime.timezone.utc), missed+1
+            else:
+                date_next = datetime.datetime.fromtimestamp(reminder.date_next, datetime.timezone.utc)
+                try:
+                    next, count = reminder_catch_up(date_next, reminder.recurrence, now, reminder.timezone)
+                except ValueError as e:
+                    # fired one last time: rescheduling it would fire it again and again
+                    log.error("Reminder %s: %s. Deleting it", reminder_id, e)
+                    deleted.append(reminder_id)
+                    nexts[reminder_id] = None
+                    occurrences[reminder_id] = count
+                    continue
+            if count > 1:
+                log.info("Reminder %s (recurring) missed %s occurrences", reminder_id, count-1)
+
+            if reminder.recurrence_limit is not None:
+                recurrence_limit = reminder.recurrence_limit-count
+                if recurrence_limit <= 0:
+                    next = None
+                    deleted.append(reminder_id)
+                    log.info("Reminder %s (recurring) has no more occurrences. Deleting it", reminder_id)
+                else:
+                    updated.append((reminder_id, next, recurrence_limit))
+                    log.info("Reminder %s (recurring) has %s more occurrences. Next occurrence: %s", reminder_id, recurrence_limit, next)
+            else:
+                updated.append((reminder_id, next, None))
+                log.info("Reminder %s (recurring) has no limit on occurrences. Next occurrence: %s", reminder_id, next)
+
+        nexts[reminder_id] = next
+        occurrences[reminder_id] = count
 
+    return nexts, occurrences, deleted, updated
 
-def reminder_next(current_next, recurrence):
+
+def reminder_next(current_next, recurrence, timezone=None):
     """
     Calculates the next time the reminder is supposed to fire.
-    (This is an easy function, but maybe in the future I will implement cron syntax in it as well...)
 
     Args:
         current_next (datetime.datetime): Datetime to update (usually now)
-        recurrence (str): Recurrence information from DB (is an expression like "4d 3h")
+        recurrence (str): Recurrence information from DB (is an expression like "4d 3h", or "cron 0 8 * * 1")
+        timezone (str, optional): IANA timezone of the reminder author, for cron recurrences. Defaults to UTC.
 
     Returns:
         datetime.datetime: Updated datetime
     """
+    if recurrence.startswith('cron '):
+        return cron.next_fire(recurrence[5:], current_next, timezone)
     return timepoint_calculation(current_next, recurrence)
 
 
+def reminder_catch_up(date_next, recurrence, now, timezone=None):
+    """
+    Calculates the first occurrence after now of a recurring reminder that was due on date_next,
+    and how many occurrences passed meanwhile.
+
+    Args:
+        date_next (datetime.datetime): When the reminder was due
+        recurrence (str): Recurrence information from DB
+        now (datetime.datetime): Datetime of reference
+        timezone (str, optional): IANA timezone of the reminder author, for cron recurrences. Defaults to UTC.
+
+    Returns:
+        datetime.datetime: Next occurrence
+        int: Occurrences that passed, including the one of date_next
+
+    Raises:
+        ValueError: If the recurrence cannot be computed, or does not move the reminder forward
+    """
+    next = reminder_next(date_next, recurrence, timezone)
+    if next <= date_next:
+        raise ValueError(f'recurrence {recurrence} does not move forward')
+    count = 1
+    if next > now:
+        return next, count
+
+    # fixed durations: no need to step through all the missed occurrences
+    delta = fixed_duration(recurrence)
+    if delta is not None:
+        skipped = (now - next) // delta + 1
+        return next + skipped*delta, count + skipped
+
+    while next <= now:
+        if count >= MAX_CATCH_UP: # giving up counting
+            return reminder_next(now, recurrence, timezone), count
+        next = reminder_next(next, recurrence, timezone)
+        count += 1
+    return next, count
+
+
+def fixed_duration(recurrence):
+    """
+    Returns the duration of a recurrence, if it is always the same.
+
+    Args:
+        recurrence (str): Recurrence information from DB
+
+    Returns:
+        datetime.timedelta: Duration, or None if it varies (months, cron)
+
+    Raises:
+        ValueError: If the duration is empty
+    """
+    if recurrence.startswith('cron ') or 'M' in recurrence or 'n' in recurrence:
+        return None
+    delta = timepoint_calculation(datetime.datetime(2000, 1, 1), recurrence) - datetime.datetime(2000, 1, 1)
+    if delta <= datetime.timedelta(0):
+        raise ValueError(f'recurrence {recurrence} is empty')
+    return delta
+
+
 def timepoint_calculation(date, timepoint):
     """
     Returns a datetime object according to the timepoint specification
@@ -0,0 +1,118 @@
+"""
+Worker processes firing reminders, when sharding is enabled in the config file.
+Each worker gets the reminders of a share of the authors (author % workers == index),
+and claims them in the shared database with a lease (see Database.claim_reminders_now):
+if a worker dies, its reminders are fired again once the lease expires.
+The gateway process keeps handling the commands, and restarts the workers that die.
+Each worker writes its logs in its own file (logs/boomerang-worker-N.log).
+"""
+
+# Project libs
+from configs import config, log
+import delivery, models, occurrences, utils
+
+# 3rd-party libs
+import discord
+
+# Standard libs
+import asyncio, datetime, multiprocessing, os, socket
+
+
+def settings():
+    return config.get('sharding') or {}
+
+
+def run(index, count):
+    """
+    Entry point of a worker process.
+
+    Args:
+        index (int): Index of the worker
+        count (int): Number of workers
+    """
+    try:
+        asyncio.run(work(index, count))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        models.AsyncDatabase.shutdown()
+        models.Database.close()
+
+
+async def work(index, count):
+    """
+    Claims the due reminders of the shard of the worker and sends them, forever.
+    Reminders are released (rescheduled or deleted) only once they have been sent.
+
+    Args:
+        index (int): Index of the worker
+        count (int): Number of workers
+    """
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    lease = settings().get('lease', 300)
+    poll = settings().get('poll', 1)
+    batch = settings().get('batch', 500)
+
+    # no gateway connection: only the REST API is used
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login(config['token'])
+    dispatcher = delivery.dispatcher(client)
+    dispatcher.start()
+    db = models.AsyncDatabase()
+    log.info(f'Worker {index+1}/{count} started ({owner})')
+
+    try:
+        while True:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            reminders = await db.claim_reminders_now(owner, lease, index, count, batch, now)
+
+            if reminders:
+                horizon = await occurrences.horizon(db, reminders)
+                nexts, counts, deleted, updated = utils.fates(reminders, now, horizon)
+                deliveries = []
+                for reminder in reminders:
+                    log.info("Reminder %s fired by worker %s", reminder.id, index+1)
+                    content = delivery.embed(reminder, nexts[reminder.id], counts[reminder.id])
+                    deliveries.append((reminder.id, reminder.author, content, reminder.date_next))
+                dispatcher.submit_all(deliveries)
+                await dispatcher.join()
+                await db.apply_reminders_fate(deleted, updated, horizon is not None)
+                if dispatcher.history is not None:
+                    await dispatcher.history.flush(db)
+
+            # more reminders may be waiting if the batch was full
+            if len(reminders) < batch:
+                await asyncio.sleep(poll)
+    finally:
+        await client.close()
+
+
+async def supervise(count):
+    """
+    Starts the worker processes, and restarts them when they die.
+    Workers are stopped when this task is cancelled.
+
+    Args:
+        count (int): Number of workers
+    """
+    context = multiprocessing.get_context('spawn') # no inherited connections or logging threads
+    processes = [None] * count
+    loop = asyncio.get_running_loop() # starting and joining processes block: done in the default executor
+
+    try:
+        while True:
+            for index, process in enumerate(processes):
+                if process is None or not process.is_alive():
+                    if process is not None:
+                        log.error(f'Worker {index+1}/{count} died (exit code {process.exitcode}), restarting it')
+                    process = context.Process(target=run, args=(index, count), name=f'boomerang-worker-{index+1}', daemon=True)
+                    await loop.run_in_executor(None, process.start)
+                    processes[index] = process
+            await asyncio.sleep(10)
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                await loop.run_in_executor(None, process.join, 5)